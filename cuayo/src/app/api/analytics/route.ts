@@ -2,6 +2,7 @@ import { NextResponse } from "next/server";
 import { spawn } from "child_process";
 import path from "path";
 import fs from "fs";
+import { callQueryServer, queryServerEnabled } from "../../lib/queryServer";
 
 type TimeOpt = "d" | "w" | "m";
 type PyUserTotals = Record<string, number>;
@@ -118,6 +119,20 @@ function runAdvicePython(args: {
   });
 }
 
+// Prefer the resident query server; socket errors (server not running) fall back to spawning.
+async function viaQueryServer<T>(
+  method: string,
+  params: Record<string, unknown>
+): Promise<T | null> {
+  if (!queryServerEnabled()) return null;
+  try {
+    return await callQueryServer<T>(method, params);
+  } catch (e: any) {
+    if (!e?.code) throw e;
+    return null;
+  }
+}
+
 export async function GET(req: Request) {
   const url = new URL(req.url);
 
@@ -137,18 +152,25 @@ export async function GET(req: Request) {
 
   const pyPath = path.join(process.cwd(), "..", "data", "rank_generator.py");
   const csvPath = path.join(path.dirname(pyPath), "credit_card_transaction.csv");
+  const columnarPath = path.join(path.dirname(pyPath), "credit_card_transaction_columns");
 
   const advicePyPath = path.join(process.cwd(), "..", "data", "ai_advice.py");
 
   try {
-    if (!fs.existsSync(pyPath)) {
+    const served = await viaQueryServer<PyUserTotals>("search_user", {
+      user_id: userId,
+      timeframe: time,
+      ref_time: refTime,
+    });
+
+    if (!served && !fs.existsSync(pyPath)) {
       return NextResponse.json(
         { ok: false, error: `rank_generator.py not found at ${pyPath}` },
         { status: 500 }
       );
     }
 
-    if (!fs.existsSync(csvPath)) {
+    if (!served && !fs.existsSync(csvPath) && !fs.existsSync(columnarPath)) {
       return NextResponse.json(
         { ok: false, error: `credit_card_transaction.csv not found at ${csvPath}` },
         { status: 500 }
@@ -162,7 +184,9 @@ export async function GET(req: Request) {
       );
     }
 
-    const py = await runPython({ pyPath, userId, time, refIso: refTime });
+    const py = served
+      ? { raw: served }
+      : await runPython({ pyPath, userId, time, refIso: refTime });
 
     const total = Number((py.raw as any).total ?? 0);
     const budget = Number((py.raw as any).budget ?? 0);
@@ -195,8 +219,15 @@ export async function GET(req: Request) {
 
     let advice = "";
     try {
-      const a = await runAdvicePython({ advicePyPath, payload: advicePayload });
-      advice = a.advice;
+      const servedAdvice = await viaQueryServer<{ advice?: string }>("advice", {
+        payload: advicePayload,
+      });
+      if (servedAdvice) {
+        advice = String(servedAdvice.advice ?? "").trim();
+      } else {
+        const a = await runAdvicePython({ advicePyPath, payload: advicePayload });
+        advice = a.advice;
+      }
     } catch {
       advice = "";
     }
@@ -2,6 +2,7 @@ import { NextResponse } from "next/server";
 import { spawn } from "child_process";
 import path from "path";
 import fs from "fs";
+import { callQueryServer, queryServerEnabled } from "../../lib/queryServer";
 
 type CategoryOpt =
   | "food_dining"
@@ -25,6 +26,17 @@ type DisplayEntry = {
   spent_ratio: number;
 };
 
+type CohortRow = {
+  cohort: string;
+  users: number;
+  amt: number;
+  avg_amt: number;
+  spent_ratio: number;
+  median_spent_ratio: number;
+  rank: number;
+  percentile: number;
+};
+
 type PyPayload = {
   userId: string;
   userName: string | null;
@@ -36,6 +48,9 @@ type PyPayload = {
   displayEntries?: DisplayEntry[];
   topPercent: number | null;
   refTime?: string;
+  // cohort rankings only (group = state / city / gender / age)
+  cohort?: string | null;
+  cohorts?: CohortRow[];
 };
 
 type Row =
@@ -66,6 +81,7 @@ function runPython(args: {
   category: CategoryOpt;
   time: TimeOpt;
   state?: string | null;
+  cohortGroup?: string | null;
 }): Promise<PyPayload> {
   return new Promise((resolve, reject) => {
     const pyPath = resolvePyPath();
@@ -80,7 +96,8 @@ function runPython(args: {
       args.time,
     ];
 
-    if (args.state) pyArgs.push("--state", args.state);
+    if (args.cohortGroup) pyArgs.push("--group", args.cohortGroup);
+    else if (args.state) pyArgs.push("--state", args.state);
 
     const child = spawn("python", pyArgs, { cwd: process.cwd() });
 
@@ -108,6 +125,37 @@ function runPython(args: {
   });
 }
 
+async function queryRankings(args: {
+  userId: string;
+  category: CategoryOpt;
+  time: TimeOpt;
+  state?: string | null;
+  cohortGroup?: string | null;
+}): Promise<PyPayload> {
+  if (queryServerEnabled()) {
+    try {
+      if (args.cohortGroup) {
+        return await callQueryServer<PyPayload>("cohort_payload", {
+          user_id: args.userId,
+          category: args.category,
+          time: args.time,
+          group: args.cohortGroup,
+        });
+      }
+      return await callQueryServer<PyPayload>("search_payload", {
+        user_id: args.userId,
+        category: args.category,
+        time: args.time,
+        state: args.state ?? null,
+      });
+    } catch (e: any) {
+      // socket errors (server not running) fall back to spawning; query errors propagate
+      if (!e?.code) throw e;
+    }
+  }
+  return runPython(args);
+}
+
 export async function GET(req: Request) {
   try {
     const url = new URL(req.url);
@@ -125,7 +173,12 @@ export async function GET(req: Request) {
     const state =
       group === "State" && groupValue ? groupValue.toUpperCase() : null;
 
-    const py = await runPython({ userId, category, time, state });
+    // Rank among the user's own City / State / Gender / Age cohort, unless a state is picked
+    // explicitly (then: all users, transactions made in that state). District has no data.
+    const cohortGroup =
+      group && group !== "District" && !state ? group.toLowerCase() : null;
+
+    const py = await queryRankings({ userId, category, time, state, cohortGroup });
 
     const meName = py.userName; 
     
@@ -193,6 +246,8 @@ export async function GET(req: Request) {
       topPercent: py.topPercent,
       userName: py.userName,
       refTime: py.refTime ?? null,
+      cohort: py.cohort ?? null,
+      cohorts: py.cohorts ?? [],
     });
   } catch (e: any) {
     return NextResponse.json(
@@ -0,0 +1,103 @@
+import net from "net";
+
+// Client for data/query_server.py (newline-delimited JSON over TCP or a Unix socket).
+// Enabled only when QUERY_SERVER_SOCKET or QUERY_SERVER_PORT is set; routes fall back
+// to spawning python otherwise.
+
+const SOCKET_PATH = process.env.QUERY_SERVER_SOCKET;
+const HOST = process.env.QUERY_SERVER_HOST ?? "127.0.0.1";
+const PORT = process.env.QUERY_SERVER_PORT ? Number(process.env.QUERY_SERVER_PORT) : null;
+const TIMEOUT_MS = Number(process.env.QUERY_SERVER_TIMEOUT_MS ?? 30000);
+
+type Pending = {
+  resolve: (v: any) => void;
+  reject: (e: Error) => void;
+  timer: ReturnType<typeof setTimeout>;
+};
+
+let socket: net.Socket | null = null;
+let connecting: Promise<net.Socket> | null = null;
+let buffer = "";
+let nextId = 1;
+const pending = new Map<number, Pending>();
+
+export function queryServerEnabled(): boolean {
+  return Boolean(SOCKET_PATH) || PORT !== null;
+}
+
+function failAll(err: Error) {
+  for (const [id, p] of pending) {
+    clearTimeout(p.timer);
+    p.reject(err);
+    pending.delete(id);
+  }
+}
+
+function onData(chunk: Buffer) {
+  buffer += chunk.toString("utf8");
+  let idx: number;
+  while ((idx = buffer.indexOf("\n")) >= 0) {
+    const line = buffer.slice(0, idx).trim();
+    buffer = buffer.slice(idx + 1);
+    if (!line) continue;
+
+    let msg: { id?: number; ok?: boolean; result?: any; error?: string };
+    try {
+      msg = JSON.parse(line);
+    } catch {
+      continue;
+    }
+    const p = msg.id !== undefined ? pending.get(msg.id) : undefined;
+    if (!p) continue;
+    pending.delete(msg.id as number);
+    clearTimeout(p.timer);
+    if (msg.ok) p.resolve(msg.result);
+    else p.reject(new Error(msg.error || "query server error"));
+  }
+}
+
+function connect(): Promise<net.Socket> {
+  if (socket && !socket.destroyed) return Promise.resolve(socket);
+  if (connecting) return connecting;
+
+  connecting = new Promise((resolve, reject) => {
+    const s = SOCKET_PATH
+      ? net.createConnection({ path: SOCKET_PATH })
+      : net.createConnection({ host: HOST, port: PORT as number });
+
+    s.once("connect", () => {
+      socket = s;
+      buffer = "";
+      connecting = null;
+      resolve(s);
+    });
+    s.on("data", onData);
+    s.on("error", (err) => {
+      connecting = null;
+      reject(err);
+      failAll(err);
+    });
+    s.on("close", () => {
+      if (socket === s) socket = null;
+      failAll(new Error("query server connection closed"));
+    });
+  });
+  return connecting;
+}
+
+export async function callQueryServer<T = any>(
+  method: string,
+  params: Record<string, unknown>
+): Promise<T> {
+  const s = await connect();
+  const id = nextId++;
+
+  return new Promise<T>((resolve, reject) => {
+    const timer = setTimeout(() => {
+      pending.delete(id);
+      reject(new Error(`query server timed out on ${method}`));
+    }, TIMEOUT_MS);
+    pending.set(id, { resolve, reject, timer });
+    s.write(JSON.stringify({ id, method, params }) + "\n");
+  });
+}
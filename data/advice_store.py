@@ -0,0 +1,427 @@
+import datetime
+import fcntl
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS advice (
+    key TEXT PRIMARY KEY,
+    created_at TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    advice TEXT NOT NULL,
+    last_used_at TEXT
+);
+CREATE TABLE IF NOT EXISTS meta (
+    name TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+# Byte-range locks in <db>.lock used for single-flight generation; payloads sharing a stripe serialize
+LOCK_STRIPES = 4096
+
+# Cache-key tolerance (see PayloadBands): money in bands of this fraction of the budget,
+# category proportions in bands of this width; 0 keys on exact values
+MONEY_BAND = float(os.getenv("AI_ADVICE_MONEY_BAND", "0.05"))
+RATIO_BAND = float(os.getenv("AI_ADVICE_RATIO_BAND", "0.05"))
+
+# Store bounds, 0 = unbounded: least recently used entries are evicted past MAX_ENTRIES
+# entries or MAX_BYTES of payload + advice text, and entries older than TTL_DAYS are ignored
+MAX_ENTRIES = int(os.getenv("AI_ADVICE_MAX_ENTRIES", "0"))
+MAX_BYTES = int(os.getenv("AI_ADVICE_MAX_BYTES", "0"))
+TTL_DAYS = float(os.getenv("AI_ADVICE_TTL_DAYS", "0"))
+
+# Size of an entry as counted against MAX_BYTES
+ENTRY_BYTES = "length(CAST(payload AS BLOB)) + length(CAST(advice AS BLOB))"
+
+
+def _canonical(obj: Any) -> Any:
+    """Integral floats become ints, so 5 and 5.0 hash the same (as they compare equal)."""
+    if isinstance(obj, dict):
+        return {str(k): _canonical(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_canonical(v) for v in obj]
+    if isinstance(obj, float) and obj.is_integer():
+        return int(obj)
+    return obj
+
+
+def canonical_json(payload: Dict[str, Any]) -> str:
+    return json.dumps(_canonical(payload), sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+
+
+class PayloadBands:
+    """
+    Canonical, quantized form of an advice payload, used as its cache key.
+
+    A new transaction moves total, budgetDelta and the category amounts by a few cents and
+    would miss an exact-match cache although the advice would read the same. Money fields
+    are therefore replaced by their band index, in bands of money_band * budget (e.g. 0.05:
+    steps of 5% of the budget), proportions by their band index in steps of ratio_band, and
+    topCategories are sorted by category name. A band of 0 keeps the exact value.
+    """
+
+    def __init__(self, money_band: float = MONEY_BAND, ratio_band: float = RATIO_BAND):
+        self.money_band = money_band
+        self.ratio_band = ratio_band
+
+    def config(self) -> Dict[str, float]:
+        return {"money_band": self.money_band, "ratio_band": self.ratio_band}
+
+    def _money(self, value: Any, budget: float) -> Any:
+        if not self.money_band or budget <= 0 or not isinstance(value, (int, float)):
+            return value
+        return round(value / (self.money_band * budget))
+
+    def _ratio(self, value: Any) -> Any:
+        if not self.ratio_band or not isinstance(value, (int, float)):
+            return value
+        return round(value / self.ratio_band)
+
+    def canonical(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        p = dict(payload)
+        budget = p.get("budget")
+        budget = float(budget) if isinstance(budget, (int, float)) else 0.0
+        for field in ("total", "budgetDelta"):
+            if field in p:
+                p[field] = self._money(p[field], budget)
+        categories = p.get("topCategories")
+        if isinstance(categories, list) and all(isinstance(c, dict) for c in categories):
+            categories = [
+                dict(c, amount=self._money(c.get("amount"), budget), proportion=self._ratio(c.get("proportion")))
+                for c in categories
+            ]
+            p["topCategories"] = sorted(categories, key=lambda c: str(c.get("category")))
+        return p
+
+    def key(self, payload: Dict[str, Any]) -> str:
+        """sha256 of the canonical JSON of the quantized payload."""
+        return payload_key(self.canonical(payload))
+
+
+def payload_key(payload: Dict[str, Any]) -> str:
+    """sha256 of the canonical JSON of payload: equal payloads get equal keys."""
+    return hashlib.sha256(canonical_json(payload).encode("utf-8")).hexdigest()
+
+
+def utc_now(precise: bool = False) -> str:
+    """UTC time as an ISO string ending in Z; whole seconds (like createdAt) unless precise."""
+    now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    return (now if precise else now.replace(microsecond=0)).isoformat() + "Z"
+
+
+def db_path(store_path: str) -> str:
+    """The SQLite file backing a store path; a legacy response.json path maps to response.db next to it."""
+    root, ext = os.path.splitext(store_path)
+    return root + ".db" if ext == ".json" else store_path
+
+
+class AdviceStore:
+    """
+    Generated advice keyed by the hash of its (quantized, see PayloadBands) payload, in SQLite (WAL mode).
+
+    Lookups are one primary-key read and writes one INSERT, so neither depends on the
+    number of stored entries. Entries are append-only (the first advice stored for a
+    payload wins until it expires), and WAL lets several processes read and append concurrently.
+
+    single_flight(payload) coalesces concurrent generation of the same advice, across
+    threads and processes, through striped byte-range locks on <db>.lock.
+
+    The exact payload is stored with each entry; when the bands change, keys are recomputed
+    on open. Lookup hits and misses are counted in the meta table (see stats).
+
+    The store is bounded by max_entries / max_bytes (least recently used entries are evicted
+    when advice is stored) and by ttl_days (older entries count as missing and are replaced
+    when the advice is generated again). compact() applies all bounds and shrinks the file.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        bands: Optional[PayloadBands] = None,
+        max_entries: int = MAX_ENTRIES,
+        max_bytes: int = MAX_BYTES,
+        ttl_days: float = TTL_DAYS,
+    ):
+        self.path = path
+        self.bands = bands or PayloadBands()
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_days = ttl_days
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        # fcntl record locks belong to the process, so threads also need a lock per stripe
+        self._lock_fd = os.open(path + ".lock", os.O_RDWR | os.O_CREAT, 0o644)
+        self._stripes = [threading.Lock() for _ in range(LOCK_STRIPES)]
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(SCHEMA)
+            columns = [row[1] for row in self._conn.execute("PRAGMA table_info(advice)")]
+            if "last_used_at" not in columns:
+                # stores created before entries had a last use
+                self._conn.execute("ALTER TABLE advice ADD COLUMN last_used_at TEXT")
+            self._conn.execute("UPDATE advice SET last_used_at = created_at WHERE last_used_at IS NULL")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS advice_last_used ON advice (last_used_at)")
+        config = json.dumps(self.bands.config(), sort_keys=True)
+        if self._meta("key_config") != config:
+            self._rekey(config)
+
+    def _meta(self, name: str) -> Optional[str]:
+        row = self._conn.execute("SELECT value FROM meta WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else None
+
+    def _count(self, name: str, n: int = 1) -> None:
+        self._conn.execute(
+            "INSERT INTO meta (name, value) VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+            ("stat:" + name, n),
+        )
+
+    def _expiry(self) -> str:
+        """created_at before which entries are expired ("" if there is no TTL)."""
+        if not self.ttl_days:
+            return ""
+        cutoff = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=self.ttl_days)
+        return cutoff.replace(microsecond=0, tzinfo=None).isoformat() + "Z"
+
+    def _evict(self) -> int:
+        """Delete least recently used entries until the store is within max_entries and max_bytes."""
+        victims: List[str] = []
+        if self.max_entries:
+            excess = self._conn.execute("SELECT COUNT(*) FROM advice").fetchone()[0] - self.max_entries
+            if excess > 0:
+                victims += [k for (k,) in self._conn.execute(
+                    "SELECT key FROM advice ORDER BY last_used_at, rowid LIMIT ?", (excess,))]
+        if self.max_bytes:
+            excess = (self._conn.execute(f"SELECT SUM({ENTRY_BYTES}) FROM advice").fetchone()[0] or 0) - self.max_bytes
+            if excess > 0:
+                skip = set(victims)
+                for key, size in self._conn.execute(f"SELECT key, {ENTRY_BYTES} FROM advice ORDER BY last_used_at, rowid"):
+                    if excess <= 0:
+                        break
+                    if key not in skip:
+                        victims.append(key)
+                    excess -= size
+        if victims:
+            self._conn.executemany("DELETE FROM advice WHERE key = ?", [(k,) for k in victims])
+            self._count("evictions", len(victims))
+        return len(victims)
+
+    def _rekey(self, config: str) -> None:
+        """Recompute every key with the current bands; the oldest entry wins where keys now collide."""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self._conn.execute(
+                    "SELECT created_at, last_used_at, payload, advice FROM advice ORDER BY created_at, rowid"
+                ).fetchall()
+                self._conn.execute("DELETE FROM advice")
+                self._conn.executemany(
+                    "INSERT OR IGNORE INTO advice (key, created_at, last_used_at, payload, advice) VALUES (?, ?, ?, ?, ?)",
+                    [(self.bands.key(json.loads(payload)), created_at, last_used_at, payload, advice)
+                     for created_at, last_used_at, payload, advice in rows],
+                )
+                self._conn.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('key_config', ?)", (config,))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def get(self, payload: Dict[str, Any], count: bool = True) -> str:
+        """
+        Stored advice for payload (or a payload in the same bands), or "" if there is none.
+        :param count: record the lookup in the hit / miss counters
+        """
+        key = self.bands.key(payload)
+        with self._lock:
+            row = self._conn.execute("SELECT advice, payload, created_at FROM advice WHERE key = ?", (key,)).fetchone()
+            hit = bool(row and row[0] and row[0].strip() and row[2] >= self._expiry())
+            try:
+                if hit:
+                    self._conn.execute("UPDATE advice SET last_used_at = ? WHERE key = ?", (utc_now(precise=True), key))
+                if count:
+                    self._count("misses" if not hit else "exact_hits" if row[1] == canonical_json(payload) else "band_hits")
+            except sqlite3.Error:
+                pass
+        return row[0].strip() if hit else ""
+
+    def put(self, payload: Dict[str, Any], advice: str, created_at: Optional[str] = None) -> bool:
+        """
+        Store advice for payload unless there already is some that has not expired, then evict
+        down to the bounds; return True if it was stored.
+        """
+        now = utc_now(precise=True)
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                cur = self._conn.execute(
+                    "INSERT INTO advice (key, created_at, last_used_at, payload, advice) VALUES (?, ?, ?, ?, ?) "
+                    "ON CONFLICT(key) DO UPDATE SET created_at = excluded.created_at, last_used_at = excluded.last_used_at, "
+                    "payload = excluded.payload, advice = excluded.advice WHERE advice.created_at < ?",
+                    (self.bands.key(payload), created_at or utc_now(), now, canonical_json(payload), advice, self._expiry()),
+                )
+                stored = cur.rowcount > 0
+                if stored:
+                    self._evict()
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return stored
+
+    @contextmanager
+    def single_flight(self, payload: Dict[str, Any]) -> Iterator[None]:
+        """
+        Hold the generation lock for payload. The first caller generates while holding it;
+        concurrent callers (other threads or processes) block until it is released and
+        should then find the advice with get() instead of generating it again.
+        """
+        stripe = int(self.bands.key(payload)[:8], 16) % LOCK_STRIPES
+        with self._stripes[stripe]:
+            fcntl.lockf(self._lock_fd, fcntl.LOCK_EX, 1, stripe)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self._lock_fd, fcntl.LOCK_UN, 1, stripe)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM advice").fetchone()[0]
+
+    def compact(self) -> Dict[str, int]:
+        """Delete expired entries, evict down to the bounds and give the freed space back to the filesystem."""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                expired = self._conn.execute("DELETE FROM advice WHERE created_at < ?", (self._expiry(),)).rowcount
+                evicted = self._evict()
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("VACUUM")
+            self._conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        return {"expired": expired, "evicted": evicted}
+
+    def stats(self) -> Dict[str, Any]:
+        """Entry count, bytes of payload + advice text, file size, oldest / newest createdAt, bounds and hit stats."""
+        with self._lock:
+            entries, size, oldest, newest = self._conn.execute(
+                f"SELECT COUNT(*), COALESCE(SUM({ENTRY_BYTES}), 0), MIN(created_at), MAX(created_at) FROM advice"
+            ).fetchone()
+            evictions = int(self._meta("stat:evictions") or 0)
+        file_bytes = sum(os.path.getsize(p) for p in (self.path, self.path + "-wal") if os.path.exists(p))
+        return dict(
+            entries=entries, bytes=size, file_bytes=file_bytes, oldest=oldest, newest=newest, evictions=evictions,
+            max_entries=self.max_entries, max_bytes=self.max_bytes, ttl_days=self.ttl_days,
+            **self.hit_stats(), **self.bands.config(),
+        )
+
+    def hit_stats(self) -> Dict[str, Any]:
+        """Lookup counters since the store was created: exact hits, hits thanks to the bands, misses, hit rate."""
+        with self._lock:
+            counts = {name: int(self._meta("stat:" + name) or 0) for name in ("exact_hits", "band_hits", "misses")}
+        lookups = sum(counts.values())
+        counts["hit_rate"] = (counts["exact_hits"] + counts["band_hits"]) / lookups if lookups else None
+        return counts
+
+    def band_report(self, bands: PayloadBands) -> Dict[str, Any]:
+        """
+        How the stored payloads would collapse under other bands: with `distinct` keys for
+        `entries` payloads, 1 - distinct / entries of those generations would have been hits.
+        """
+        with self._lock:
+            payloads = [json.loads(p) for (p,) in self._conn.execute("SELECT payload FROM advice")]
+        distinct = len({bands.key(p) for p in payloads})
+        return {"entries": len(payloads), "distinct": distinct,
+                "hit_rate": 1 - distinct / len(payloads) if payloads else None}
+
+    def migrate_json(self, json_path: str) -> int:
+        """
+        One-time import of a legacy response.json (a list of {createdAt, payload, advice}).
+        Recorded in the meta table, so later calls for the same file do nothing.
+        :return: number of entries imported
+        """
+        marker = "migrated:" + os.path.abspath(json_path)
+        with self._lock:
+            if self._conn.execute("SELECT 1 FROM meta WHERE name = ?", (marker,)).fetchone():
+                return 0
+        try:
+            with open(json_path, "r", encoding="utf-8") as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            entries = []
+        rows = [
+            (self.bands.key(e["payload"]), str(e.get("createdAt") or utc_now()), canonical_json(e["payload"]), e["advice"].strip())
+            for e in (entries if isinstance(entries, list) else [])
+            if isinstance(e, dict) and isinstance(e.get("payload"), dict) and isinstance(e.get("advice"), str) and e["advice"].strip()
+        ]
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                before = self._conn.total_changes
+                self._conn.executemany(
+                    "INSERT OR IGNORE INTO advice (key, created_at, last_used_at, payload, advice) VALUES (?, ?, ?, ?, ?)",
+                    [(key, created_at, created_at, payload, advice) for key, created_at, payload, advice in rows],
+                )
+                imported = self._conn.total_changes - before
+                self._evict()
+                self._conn.execute("INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)", (marker, utc_now()))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return imported
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+            os.close(self._lock_fd)
+
+
+_stores: Dict[str, AdviceStore] = {}
+_stores_lock = threading.Lock()
+
+
+def open_store(store_path: str) -> AdviceStore:
+    """
+    Return the (process-wide) AdviceStore for store_path. A legacy response.json path opens
+    response.db next to it and migrates the JSON entries into it on first use.
+    """
+    path = db_path(store_path)
+    with _stores_lock:
+        store = _stores.get(path)
+        if store is None:
+            store = AdviceStore(path)
+            if path != store_path and os.path.exists(store_path):
+                store.migrate_json(store_path)
+            _stores[path] = store
+        return store
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", choices=["migrate", "stats", "bands", "compact"])
+    parser.add_argument("--store_path", type=str, default=os.getenv("AI_ADVICE_STORE_PATH")
+                        or os.path.join(os.path.dirname(__file__), "response.json"))
+    parser.add_argument("--money_band", type=float, default=MONEY_BAND, help="bands to evaluate (bands command)")
+    parser.add_argument("--ratio_band", type=float, default=RATIO_BAND, help="bands to evaluate (bands command)")
+    args = parser.parse_args()
+
+    store = AdviceStore(db_path(args.store_path))
+    if args.command == "migrate":
+        print(f"imported {store.migrate_json(args.store_path)} entries from {args.store_path} into {store.path}")
+    elif args.command == "compact":
+        print(json.dumps(dict(store.compact(), **store.stats())))
+    elif args.command == "bands":
+        print(json.dumps(dict(store.band_report(PayloadBands(args.money_band, args.ratio_band)),
+                              money_band=args.money_band, ratio_band=args.ratio_band)))
+    else:
+        print(json.dumps(dict(store.stats(), path=store.path)))
@@ -1,10 +1,10 @@
 import json
 import os
 import sys
-import datetime
-from typing import Any, Dict, List
+import threading
+from typing import Any, Callable, Dict, Iterator, Optional
 
-from openai import OpenAI
+from advice_store import open_store
 
 try:
     sys.stdout.reconfigure(encoding="utf-8")
@@ -19,35 +19,6 @@ def read_payload() -> Dict[str, Any]:
     return json.loads(raw)
 
 
-def load_store(path: str) -> List[Dict[str, Any]]:
-    if not os.path.exists(path):
-        return []
-    try:
-        with open(path, "r", encoding="utf-8") as f:
-            data = json.load(f)
-        return data if isinstance(data, list) else []
-    except Exception:
-        return []
-
-
-def atomic_write(path: str, data: List[Dict[str, Any]]) -> None:
-    tmp = path + ".tmp"
-    with open(tmp, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
-    os.replace(tmp, path)
-
-
-def find_match(entries, payload) -> str:
-    for e in entries:
-        if not isinstance(e, dict):
-            continue
-        if e.get("payload") == payload and isinstance(e.get("advice"), str):
-            adv = e["advice"].strip()
-            if adv:
-                return adv
-    return ""
-
-
 def build_prompt(payload: Dict[str, Any]) -> Dict[str, Any]:
     mode = str(payload.get("mode", "short")).lower()
     if mode not in ("short", "detailed"):
@@ -100,11 +71,28 @@ def load_api_key(path="api.txt"):
     with open(path, "r", encoding="utf-8-sig") as f:
         return f.read().strip()
 
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """
+    The OpenAI client, created on first use and reused afterwards, so a long-lived process
+    (query server, batch pre-generation) keeps its HTTP connection pool.
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            # Imported here so cache hits never pay for loading the SDK
+            from openai import OpenAI
+            _client = OpenAI(api_key=load_api_key())
+        return _client
+
+
 def generate_advice(prompt: str, max_tokens: int) -> str:
-    api_key = load_api_key()
     model = os.getenv("OPENAI_MODEL", "gpt-5.2")
-    
-    client = OpenAI(api_key=api_key)
+
+    client = get_client()
     resp = client.responses.create(
         model=model,
         input=prompt,
@@ -114,41 +102,129 @@ def generate_advice(prompt: str, max_tokens: int) -> str:
     return text
 
 
-def main():
-    payload = read_payload()
+def stream_generate_advice(prompt: str, max_tokens: int) -> Iterator[str]:
+    """Like generate_advice, but yields the advice text in chunks as the model produces them."""
+    model = os.getenv("OPENAI_MODEL", "gpt-5.2")
+
+    client = get_client()
+    stream = client.responses.create(
+        model=model,
+        input=prompt,
+        max_output_tokens=max_tokens,
+        stream=True,
+    )
+    for event in stream:
+        if getattr(event, "type", "") == "response.output_text.delta":
+            yield event.delta
 
+
+def default_store_path() -> str:
     store_path = os.getenv("AI_ADVICE_STORE_PATH")
     if not store_path:
         store_path = os.path.join(os.path.dirname(__file__), "response.json")
+    return store_path
+
+
+def get_advice(
+    payload: Dict[str, Any],
+    store_path: str = "",
+    generate: Optional[Callable[[str, int], str]] = None,
+) -> Dict[str, Any]:
+    """
+    Cached advice for payload, generating (and storing) it on a miss.
+
+    Concurrent misses for the same payload, in this process or others, are coalesced:
+    one caller generates and the rest wait for it and return its advice.
 
-    entries = load_store(store_path)
+    :param payload: advice payload built by the analytics route
+    :param store_path: advice store path, default_store_path() if empty
+    :param generate: generate(prompt, max_tokens) -> advice text, generate_advice if None
+    """
+    store = open_store(store_path or default_store_path())
+    generate = generate or generate_advice
 
-    # 1) cache from response.json
-    hit = find_match(entries, payload)
+    # 1) cache lookup by payload hash
+    hit = store.get(payload)
     if hit:
-        print(json.dumps({"ok": True, "advice": hit, "cached": True}, ensure_ascii=False))
-        return
+        return {"ok": True, "advice": hit, "cached": True}
+
+    with store.single_flight(payload):
+        # A concurrent caller may have generated it while we waited for the lock
+        hit = store.get(payload, count=False)
+        if hit:
+            return {"ok": True, "advice": hit, "cached": True}
+
+        # 2) generate if not
+        p = build_prompt(payload)
+        advice = generate(p["prompt"], p["max_tokens"])
+
+        # 3) store every time (append-only; a concurrent writer's entry wins)
+        try:
+            store.put(payload, advice)
+        except Exception:
+            pass
+
+    return {"ok": True, "advice": advice, "cached": False}
+
+
+def stream_advice(
+    payload: Dict[str, Any],
+    store_path: str = "",
+    stream: Optional[Callable[[str, int], Iterator[str]]] = None,
+) -> Iterator[Dict[str, Any]]:
+    """
+    Streaming variant of get_advice. Yields events:
+        {"type": "delta", "text": "..."}                                  as text arrives
+        {"type": "done", "ok": true, "advice": "...", "cached": bool}     once complete
+    A cache hit is replayed as a single delta followed by done, so callers handle one protocol.
+    The complete advice is stored once the stream has finished.
+
+    :param stream: stream(prompt, max_tokens) -> iterator of text chunks, stream_generate_advice if None
+    """
+    store = open_store(store_path or default_store_path())
+    stream = stream or stream_generate_advice
+
+    hit = store.get(payload)
+    if not hit:
+        with store.single_flight(payload):
+            # A concurrent caller may have generated it while we waited for the lock
+            hit = store.get(payload, count=False)
+            if not hit:
+                p = build_prompt(payload)
+                parts = []
+                for text in stream(p["prompt"], p["max_tokens"]):
+                    if text:
+                        parts.append(text)
+                        yield {"type": "delta", "text": text}
+                advice = "".join(parts).strip()
+                try:
+                    store.put(payload, advice)
+                except Exception:
+                    pass
+                yield {"type": "done", "ok": True, "advice": advice, "cached": False}
+                return
+
+    yield {"type": "delta", "text": hit}
+    yield {"type": "done", "ok": True, "advice": hit, "cached": True}
 
-    # 2) generate if not
-    p = build_prompt(payload)
-    advice = generate_advice(p["prompt"], p["max_tokens"])
-
-    # 3) store every time
-    now = datetime.datetime.utcnow().replace(microsecond=0).isoformat() + "Z"
-    entries.append(
-        {
-            "createdAt": now,
-            "payload": payload,
-            "advice": advice,
-        }
-    )
 
-    try:
-        atomic_write(store_path, entries)
-    except Exception:
-        pass
+def main():
+    import argparse
 
-    print(json.dumps({"ok": True, "advice": advice, "cached": False}, ensure_ascii=False))
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--stream", action="store_true", help="write NDJSON events as the advice is generated")
+    args = parser.parse_args()
+
+    payload = read_payload()
+    if not args.stream:
+        print(json.dumps(get_advice(payload), ensure_ascii=False))
+        return
+    try:
+        for event in stream_advice(payload):
+            print(json.dumps(event, ensure_ascii=False), flush=True)
+    except Exception as e:
+        print(json.dumps({"type": "error", "ok": False, "error": f"{type(e).__name__}: {e}"}, ensure_ascii=False), flush=True)
+        sys.exit(1)
 
 
 if __name__ == "__main__":
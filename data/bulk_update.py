@@ -0,0 +1,15 @@
+from rank_generator import update_df_many
+import argparse
+import sys
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Append batches of transactions (CSV or JSONL files, '-' for stdin).")
+    parser.add_argument("files", nargs="+")
+    parser.add_argument("--format", choices=["csv", "jsonl"], default=None,
+                        help="input format; guessed from the file extension if omitted (stdin defaults to csv)")
+    args = parser.parse_args()
+
+    for path in args.files:
+        source = sys.stdin if path == "-" else path
+        count = update_df_many(source, fmt=args.format)
+        print(f"{path}: {count} transactions")
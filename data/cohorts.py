@@ -0,0 +1,226 @@
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from leaderboard import NEIGHBOR_RADIUS, RATIO_SCALE, TOP_K, ratio_keys, window_bounds
+
+# Cohort dimensions, read from the user directory (each user's home attributes)
+DIMENSIONS = ['state', 'city', 'gender', 'age']
+
+# Age bands of the age dimension: ages below AGE_BINS[0] are AGE_LABELS[0], and so on
+AGE_BINS = [18, 25, 35, 45, 55, 65]
+AGE_LABELS = ['<18', '18-24', '25-34', '35-44', '45-54', '55-64', '65+']
+
+# Number of (category, time, ref_unix) cubes kept warm
+MAX_CUBES = int(os.getenv("COHORT_CACHE_SIZE", "64"))
+
+COHORT_COLUMNS = ['cohort', 'users', 'amt', 'avg_amt', 'spent_ratio', 'median_spent_ratio', 'rank', 'percentile']
+
+
+def age_band(age):
+    """AGE_LABELS band of each age; NaN ages get None."""
+    age = np.asarray(age, dtype=np.float64)
+    bands = np.asarray(AGE_LABELS, dtype=object)[np.digitize(np.nan_to_num(age), AGE_BINS)]
+    bands[np.isnan(age)] = None
+    return bands
+
+
+class CohortGroups:
+    """
+    Users of a cube grouped by one dimension, sorted by spent_ratio within each cohort.
+    Cohort c holds order[starts[c]:starts[c + 1]]; where[i] is user i's position in order.
+    """
+
+    def __init__(self, values, keys, cents):
+        codes, labels = pd.factorize(pd.Series(values, dtype=object))
+        self.labels = np.asarray(labels, dtype=object)
+        self.codes = codes
+        valid = np.flatnonzero(codes >= 0)
+        self.order = valid[np.lexsort((keys[valid], codes[valid]))]
+        self.starts = np.searchsorted(codes[self.order], np.arange(len(labels) + 1))
+        self.where = np.full(len(codes), -1, dtype=np.int64)
+        self.where[self.order] = np.arange(len(self.order))
+        self.sorted_keys = keys[self.order]
+
+        # Cohort aggregates in one bincount pass each
+        n = len(labels)
+        self.users = np.bincount(codes[valid], minlength=n)
+        self.cents = np.bincount(codes[valid], weights=cents[valid], minlength=n).astype(np.int64)
+        self.key_sums = np.bincount(codes[valid], weights=keys[valid], minlength=n)
+        self.median_keys = self.sorted_keys[self.starts[:-1] + (self.users - 1) // 2]
+
+    def code(self, label):
+        found = np.flatnonzero(self.labels == label)
+        return int(found[0]) if len(found) else None
+
+    def segment(self, c):
+        return self.starts[c], self.starts[c + 1]
+
+
+class CohortCube:
+    """
+    Spend of every user with transactions in one (category, time, ref_unix) window, with
+    users pre-grouped by every cohort dimension. Both "rank among my cohort" (member) and
+    "cohorts against each other" (table) are lookups into these arrays.
+
+    Users are ranked by spent_ratio ascending with min ties, as in search_df; only users
+    with a nonzero spent_ratio are ranked.
+    """
+
+    def __init__(self, time, user_ids, cents, salary, names, attributes):
+        """
+        :param user_ids, cents, salary, names: window totals, one entry per user
+        :param attributes: dimension -> cohort of each user (aligned with user_ids)
+        """
+        keys = ratio_keys(cents, salary, time)
+        active = keys > 0
+        self.time = time
+        self.user_ids = pd.Index(np.asarray(user_ids, dtype=object)[active])
+        self.keys = keys[active]
+        self.cents = np.asarray(cents, dtype=np.int64)[active]
+        self.names = np.asarray(names, dtype=object)[active]
+        self.groups = {dim: CohortGroups(np.asarray(values, dtype=object)[active], self.keys, self.cents)
+                       for dim, values in attributes.items()}
+
+    def _entry(self, groups, p):
+        """Name, spent_ratio and rank (min ties within the cohort) of sorted position p."""
+        c = groups.codes[groups.order[p]]
+        lo, hi = groups.segment(c)
+        key = groups.sorted_keys[p]
+        rank = int(np.searchsorted(groups.sorted_keys[lo:hi], key, side='left')) + 1
+        return {"name": self.names[groups.order[p]], "spent_ratio": key / RATIO_SCALE, "rank": rank}
+
+    def member(self, user_id, dimension, cohort=None, k=TOP_K, radius=NEIGHBOR_RADIUS):
+        """
+        Rank of user_id among the users of a cohort of dimension, with its top k entries and
+        the radius users right before and after the user.
+
+        :param cohort: cohort to rank in; the user's own cohort if None
+        :return: dict with cohort, userSpentRatio, userRank, numUsers, entries (top k, then the
+            user's neighbors, each with name, spent_ratio and rank) and topPercent
+        """
+        groups = self.groups[dimension]
+        i = self.user_ids.get_indexer([user_id])[0]
+        if cohort is None and i >= 0:
+            c = int(groups.codes[i]) if groups.codes[i] >= 0 else None
+        else:
+            c = None if cohort is None else groups.code(cohort)
+        result = {"cohort": None if c is None else groups.labels[c], "userSpentRatio": 0.0,
+                  "userRank": None, "numUsers": 0, "entries": [], "topPercent": None}
+        if c is None:
+            return result
+        lo, hi = groups.segment(c)
+        positions = list(range(lo, min(lo + k, hi)))
+        result["numUsers"] = int(hi - lo)
+        if i >= 0 and groups.codes[i] == c:
+            p = int(groups.where[i])
+            rank = int(np.searchsorted(groups.sorted_keys[lo:hi], self.keys[i], side='left')) + 1
+            result.update(userSpentRatio=self.keys[i] / RATIO_SCALE, userRank=rank,
+                          topPercent=rank / (hi - lo) * 100)
+            positions += [q for q in range(max(p - radius, lo), min(p + radius + 1, hi)) if q >= lo + k]
+        result["entries"] = [self._entry(groups, q) for q in positions]
+        return result
+
+    def table(self, dimension):
+        """
+        Cohorts of dimension against each other: one row per cohort with its ranked users,
+        total and average spend, mean and median spent_ratio, and rank / percentile by mean
+        spent_ratio (ascending, min ties), in rank order.
+        """
+        groups = self.groups[dimension]
+        users = groups.users
+        keep = users > 0
+        mean_keys = np.where(keep, groups.key_sums / np.maximum(users, 1), 0)
+        table = pd.DataFrame({
+            'cohort': groups.labels[keep],
+            'users': users[keep],
+            'amt': groups.cents[keep] / 100,
+            'avg_amt': np.round(groups.cents[keep] / 100 / users[keep], 2),
+            'spent_ratio': np.round(mean_keys[keep] / RATIO_SCALE, 4),
+            'median_spent_ratio': groups.median_keys[keep] / RATIO_SCALE,
+        })
+        table['rank'] = table['spent_ratio'].rank(method='min').astype(np.int64)
+        table['percentile'] = table['rank'] / max(len(table), 1) * 100
+        return table.sort_values(['rank', 'cohort'], kind='stable').reset_index(drop=True)[COHORT_COLUMNS]
+
+
+class CohortEngine:
+    """
+    CohortCubes kept warm per (category, time, ref_unix) in an LRU of max_cubes entries.
+    A cube is built in one pass over the daily aggregates (every user's window spend) plus
+    one grouping per dimension; rows appended to the store or a reload drop the cached cubes.
+
+    category None (or "all") ranks spend over all categories.
+    """
+
+    def __init__(self, store, max_cubes=MAX_CUBES):
+        self.store = store
+        self.max_cubes = max_cubes
+        self.cubes = OrderedDict()
+        self.counters = dict.fromkeys(['hits', 'misses', 'evictions', 'invalidations'], 0)
+        self._lock = threading.RLock()
+        store.subscribe(self.on_rows)
+
+    def on_rows(self, rows):
+        with self._lock:
+            if self.cubes:
+                self.counters['invalidations'] += 1
+            self.cubes.clear()
+
+    def totals(self, category, time, ref_unix):
+        aggregates, index, df = self.store.aggregates()
+        start, end = window_bounds(time, ref_unix)
+        categories = aggregates.categories if category in (None, 'all') else [category]
+        cents = np.zeros(aggregates.n_users, dtype=np.int64)
+        for c in categories:
+            cents += aggregates.category_totals(df, index, c, start, end)[0]
+        n = len(aggregates.users)
+        return aggregates.users, cents[:n], aggregates.salary, aggregates.names
+
+    def build(self, category, time, ref_unix):
+        user_ids, cents, salary, names = self.totals(category, time, ref_unix)
+        users = self.store.users()
+        dimensions = [d for d in DIMENSIONS if d in users.attributes]
+        info = users.gather(user_ids, dimensions)
+        attributes = {d: age_band(info[d]) if d == 'age' else info[d].to_numpy(dtype=object) for d in dimensions}
+        return CohortCube(time, user_ids, cents, salary, names, attributes)
+
+    def cube(self, category, time, ref_unix):
+        """Return the cube for the key, building it on first use."""
+        key = (category, time, ref_unix)
+        with self.store.lock, self._lock:
+            # Pick up appended rows first (they invalidate the cached cubes through on_rows)
+            self.store.df
+            cube = self.cubes.get(key)
+            if cube is None:
+                self.counters['misses'] += 1
+                cube = self.build(category, time, ref_unix)
+                self.cubes[key] = cube
+                while len(self.cubes) > self.max_cubes:
+                    self.cubes.popitem(last=False)
+                    self.counters['evictions'] += 1
+            else:
+                self.counters['hits'] += 1
+                self.cubes.move_to_end(key)
+            return cube
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, cubes=len(self.cubes), max_cubes=self.max_cubes)
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_cohort_engine():
+    """Return the process-wide CohortEngine over the process-wide store."""
+    global _engine
+    from transaction_store import get_store
+    with _engine_lock:
+        if _engine is None:
+            _engine = CohortEngine(get_store())
+        return _engine
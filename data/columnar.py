@@ -0,0 +1,187 @@
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+import pandas as pd
+
+FORMAT_VERSION = 1
+META_FILE = "_meta.json"
+
+# Columns every query in rank_generator / history_generator needs
+QUERY_COLUMNS = ['user_id', 'category', 'unix_time', 'amt', 'state', 'salary', 'name']
+
+
+def table_path(csv_path):
+    """Return the columnar table directory that sits next to csv_path."""
+    root, _ = os.path.splitext(csv_path)
+    return root + "_columns"
+
+
+def exists(path):
+    return os.path.exists(os.path.join(path, META_FILE))
+
+
+def read_meta(path):
+    with open(os.path.join(path, META_FILE), "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def write_part(df, part_dir):
+    """
+    Write df as one .npy file per column in part_dir.
+    String columns are dictionary encoded as <col>.codes.npy (int32, -1 for NaN)
+    and <col>.dict.npy (fixed width unicode), so no pickling is needed to load them.
+
+    Parts written outside TableWriter.write (e.g. by worker processes, into
+    TableWriter.part_path(name)) are registered with TableWriter.add_part.
+    :return: column kinds, as add_part expects them
+    """
+    os.makedirs(part_dir, exist_ok=True)
+    kinds = {}
+    for col in df.columns:
+        s = df[col]
+        if pd.api.types.is_numeric_dtype(s) and not pd.api.types.is_bool_dtype(s):
+            np.save(os.path.join(part_dir, col + ".npy"), s.to_numpy())
+            kinds[col] = str(s.dtype)
+        else:
+            codes, uniques = pd.factorize(s.astype(object))
+            np.save(os.path.join(part_dir, col + ".codes.npy"), codes.astype(np.int32))
+            np.save(os.path.join(part_dir, col + ".dict.npy"), np.asarray(uniques, dtype=str))
+            kinds[col] = "dict"
+    return kinds
+
+
+class TableWriter:
+    """
+    Write a columnar table one part at a time, so a table larger than memory can be
+    written from a stream of DataFrame chunks.
+
+    Parts go to a new version directory inside path (data_dir). close() swaps the table in
+    with a single rename of its metadata file, which names the version directory as the
+    table's root, so readers see either the previous table or the new one, never neither.
+    The previous version is removed after the swap.
+
+    Every part must have the same columns; numeric columns keep the first part's dtype.
+    """
+
+    def __init__(self, path, meta=None):
+        self.path = path
+        self.version = f"v-{time.time_ns():x}-{os.getpid()}"
+        self.data_dir = os.path.join(path, self.version)
+        self.meta = dict(meta or {})
+        self.kinds = None
+        self.parts = []
+        self.rows = 0
+        os.makedirs(self.data_dir)
+
+    def write(self, df):
+        if self.kinds is not None:
+            if list(df.columns) != list(self.kinds):
+                raise ValueError(f"part columns {list(df.columns)} do not match {list(self.kinds)}")
+            df = df.astype({c: k for c, k in self.kinds.items() if k != "dict"}, copy=False)
+        name = f"part-{len(self.parts):05d}"
+        self.add_part(name, write_part(df, self.part_path(name)), len(df))
+
+    def part_path(self, name):
+        """Directory the part called name is written to."""
+        return os.path.join(self.data_dir, name)
+
+    def add_part(self, name, kinds, rows):
+        """Register a part that was written to part_path(name) elsewhere, e.g. by a worker process."""
+        if self.kinds is None:
+            self.kinds = kinds
+        elif kinds != self.kinds:
+            raise ValueError(f"part {name} has columns {kinds}, expected {self.kinds}")
+        self.parts.append(name)
+        self.rows += int(rows)
+
+    def close(self):
+        if self.kinds is None:
+            raise ValueError("no parts were written")
+        old = read_meta(self.path) if exists(self.path) else None
+        meta = dict(self.meta, format=FORMAT_VERSION, rows=int(self.rows), columns=self.kinds,
+                    root=self.version, parts=self.parts)
+        tmp = os.path.join(self.path, META_FILE + ".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(meta, f, indent=2)
+        os.replace(tmp, os.path.join(self.path, META_FILE))
+
+        # Remove the previous version: its root, or the parts of a table written before versioning
+        if old is not None:
+            stale = [old["root"]] if old.get("root") else old["parts"]
+            for name in stale:
+                if name != self.version:
+                    shutil.rmtree(os.path.join(self.path, name), ignore_errors=True)
+
+
+def write_table(df, path, meta=None):
+    """
+    Write df to the columnar table directory at path, replacing any previous table.
+    The table is built in a new version directory and swapped in at the end (see TableWriter).
+
+    :param meta: extra JSON-serializable entries to store in the table's metadata
+    """
+    writer = TableWriter(path, meta)
+    writer.write(df)
+    writer.close()
+
+
+def _read_column(path, parts, col, kind, mmap):
+    mmap_mode = "r" if mmap else None
+    if kind != "dict":
+        arrays = [np.load(os.path.join(path, p, col + ".npy"), mmap_mode=mmap_mode) for p in parts]
+        return arrays[0] if len(arrays) == 1 else np.concatenate(arrays)
+
+    # Merge the per-part dictionaries into one and remap every part's codes onto it
+    dicts = [np.load(os.path.join(path, p, col + ".dict.npy")) for p in parts]
+    codes = [np.load(os.path.join(path, p, col + ".codes.npy"), mmap_mode=mmap_mode) for p in parts]
+    if len(parts) == 1:
+        categories, all_codes = dicts[0], np.asarray(codes[0])
+    else:
+        categories = pd.unique(np.concatenate(dicts).astype(object))
+        index = pd.Index(categories)
+        remapped = []
+        for d, c in zip(dicts, codes):
+            lookup = np.append(index.get_indexer(d.astype(object)), -1).astype(np.int32)
+            remapped.append(lookup[c])
+        all_codes = np.concatenate(remapped)
+    return pd.Categorical.from_codes(all_codes, categories=pd.Index(categories.astype(object)))
+
+
+def read_table(path, columns=None, mmap=True, partitions=None):
+    """
+    Read the columnar table at path.
+
+    :param columns: list of columns to load, all columns if None
+    :param mmap: memory-map numeric columns instead of reading them eagerly
+    :param partitions: for a partitioned table (see dataset_prep.prepare_parallel), the partition
+        numbers to load, all partitions if None
+    :return: DataFrame with string columns as pandas Categoricals
+    """
+    meta = read_meta(path)
+    kinds = meta["columns"]
+    parts = meta["parts"]
+    root = os.path.join(path, meta.get("root", ""))
+    if partitions is not None:
+        if "partitions" not in meta:
+            raise ValueError(f"{path} is not partitioned")
+        parts = [part for p in partitions for part in meta["partitions"][p]]
+        if not parts:
+            return pd.DataFrame(columns=columns or list(kinds))
+    if columns is None:
+        columns = list(kinds)
+    data = {}
+    for col in columns:
+        if col not in kinds:
+            raise KeyError(f"column {col!r} not found in {path}")
+        data[col] = _read_column(root, parts, col, kinds[col], mmap)
+    return pd.DataFrame(data)
+
+
+def convert_csv(csv_path, path=None):
+    """One-shot conversion of an existing transaction CSV into the columnar format."""
+    path = path or table_path(csv_path)
+    write_table(pd.read_csv(csv_path), path)
+    return path
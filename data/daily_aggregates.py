@@ -0,0 +1,154 @@
+import numpy as np
+import pandas as pd
+
+DAY = 86400
+
+# Rebuild once the rows appended after the build (the journal tail) exceed this many
+MAX_TAIL_ROWS = 20000
+
+
+def to_cents(amt):
+    """Amounts as exact integer cents, so window sums do not depend on summation order."""
+    return np.rint(np.asarray(amt, dtype=np.float64) * 100).astype(np.int64)
+
+
+class DailyAggregates:
+    """
+    Per-(category, user, day) spend with cumulative sums along the day axis.
+
+    Cells are stored sparsely: one entry per (category, user, day) that has transactions,
+    sorted by that key, with running totals of cents and transaction counts. The spend of
+    every user in a window of whole days is then a difference of two prefix sums, found
+    with one vectorized searchsorted over all users. Windows are [start, end] in seconds and
+    need not be day aligned: the partial days at either end are added from the TimeIndex,
+    and rows appended after the build (the journal tail) from a scan of the tail.
+
+    Users are identified by integer codes; users / salary / names map codes to attributes
+    (first row of each user in the table).
+    """
+
+    def __init__(self, df):
+        self.size = len(df)
+        # Rows up to here are known to have categories and users the aggregates have codes for
+        self.checked = len(df)
+        times = df['unix_time'].to_numpy(dtype=np.int64)
+        cat_codes, categories = pd.factorize(df['category'])
+        user_codes, users = pd.factorize(df['user_id'])
+        self.categories = pd.Index(categories)
+        self.users = pd.Index(users)
+        first_rows = np.unique(user_codes[user_codes >= 0], return_index=True)[1]
+        first_rows = np.flatnonzero(user_codes >= 0)[first_rows]
+        self.salary = df['salary'].to_numpy(dtype=np.float64)[first_rows]
+        self.names = np.asarray(df['name'].to_numpy(dtype=object)[first_rows]) if 'name' in df.columns else np.full(len(users), None, dtype=object)
+        self.n_categories = max(len(categories), 1)
+        self.n_users = max(len(users), 1)
+
+        self.origin = int(times.min() // DAY * DAY) if len(times) else 0
+        self.n_days = int((times.max() - self.origin) // DAY + 1) if len(times) else 0
+        days = (times - self.origin) // DAY
+
+        valid = (cat_codes >= 0) & (user_codes >= 0)
+        keys = self._key(cat_codes[valid], user_codes[valid], days[valid])
+        self.keys, inverse = np.unique(keys, return_inverse=True)
+        cents = np.bincount(inverse, weights=to_cents(df['amt'].to_numpy()[valid]), minlength=len(self.keys))
+        counts = np.bincount(inverse, minlength=len(self.keys))
+        self.cum_cents = np.concatenate([[0], np.cumsum(np.rint(cents).astype(np.int64))])
+        self.cum_counts = np.concatenate([[0], np.cumsum(counts.astype(np.int64))])
+
+    def _key(self, cat, user, day):
+        return (np.asarray(cat, dtype=np.int64) * self.n_users + user) * (self.n_days + 1) + day
+
+    def covers(self, df):
+        """
+        True if df is this table plus a tail short enough to scan, whose categories and users
+        all have codes. The tail is only added for known codes, so a category or user first seen
+        in the tail (e.g. a new category from update_df) needs a rebuild.
+        """
+        if not self.size <= len(df) <= self.size + MAX_TAIL_ROWS:
+            return False
+        if len(df) > self.checked:
+            new = df.iloc[self.checked:]
+            if (self.categories.get_indexer(new['category']) < 0).any() or (self.users.get_indexer(new['user_id']) < 0).any():
+                return False
+            self.checked = len(df)
+        return True
+
+    def user_code(self, user_id):
+        code = self.users.get_indexer([user_id])[0]
+        return None if code < 0 else int(code)
+
+    def _split(self, start, end):
+        """
+        Split [start, end] into whole day buckets [b0, b1) and the partial edges around them.
+        :return: b0, b1, list of (start, end) edge ranges
+        """
+        start = np.iinfo(np.int64).min // 2 if start is None else int(np.ceil(start))
+        end = np.iinfo(np.int64).max // 2 if end is None else int(np.floor(end))
+        b0 = min(max(-(-(start - self.origin) // DAY), 0), self.n_days)
+        b1 = max(min((end + 1 - self.origin) // DAY, self.n_days), 0)
+        if b0 >= b1:
+            return 0, 0, [(start, end)]
+        edges = [(start, self.origin + b0 * DAY - 1), (self.origin + b1 * DAY, end)]
+        return b0, b1, [(a, b) for a, b in edges if a <= b]
+
+    def _prefix_diff(self, key0, key1):
+        p0 = np.searchsorted(self.keys, key0, side='left')
+        p1 = np.searchsorted(self.keys, key1, side='left')
+        return self.cum_cents[p1] - self.cum_cents[p0], self.cum_counts[p1] - self.cum_counts[p0]
+
+    def _tail(self, df, b0, b1):
+        tail = df.iloc[self.size:]
+        if tail.empty or b0 >= b1:
+            return tail.iloc[:0]
+        t = tail['unix_time'].to_numpy()
+        return tail[(t >= self.origin + b0 * DAY) & (t < self.origin + b1 * DAY)]
+
+    def _add_rows(self, cents, counts, rows, codes):
+        keep = codes >= 0
+        cents += np.bincount(codes[keep], weights=to_cents(rows['amt'].to_numpy()[keep]), minlength=len(cents)).astype(np.int64)
+        counts += np.bincount(codes[keep], minlength=len(counts))
+
+    def category_totals(self, df, index, category, start, end):
+        """
+        Spend of every user in category with start <= unix_time <= end (None = unbounded).
+        :return: (cents, counts), int64 arrays indexed by user code
+        """
+        cents = np.zeros(self.n_users, dtype=np.int64)
+        counts = np.zeros(self.n_users, dtype=np.int64)
+        b0, b1, edges = self._split(start, end)
+        c = self.categories.get_indexer([category])[0]
+        if c >= 0 and b0 < b1:
+            users = np.arange(self.n_users)
+            d_cents, d_counts = self._prefix_diff(self._key(c, users, b0), self._key(c, users, b1))
+            cents += d_cents
+            counts += d_counts
+            tail = self._tail(df, b0, b1)
+            tail = tail[tail['category'] == category]
+            self._add_rows(cents, counts, tail, self.users.get_indexer(tail['user_id']))
+        for a, b in edges:
+            rows = index.window(df, a, b, category=category)
+            self._add_rows(cents, counts, rows, self.users.get_indexer(rows['user_id']))
+        return cents, counts
+
+    def user_totals(self, df, index, user_id, start, end):
+        """
+        Spend of one user in every category with start <= unix_time <= end (None = unbounded).
+        :return: (cents, counts), int64 arrays indexed like self.categories
+        """
+        n = len(self.categories)
+        cents = np.zeros(n, dtype=np.int64)
+        counts = np.zeros(n, dtype=np.int64)
+        b0, b1, edges = self._split(start, end)
+        u = self.user_code(user_id)
+        if u is not None and b0 < b1:
+            cats = np.arange(n)
+            d_cents, d_counts = self._prefix_diff(self._key(cats, u, b0), self._key(cats, u, b1))
+            cents += d_cents
+            counts += d_counts
+            tail = self._tail(df, b0, b1)
+            tail = tail[tail['user_id'] == user_id]
+            self._add_rows(cents, counts, tail, self.categories.get_indexer(tail['category']))
+        for a, b in edges:
+            rows = index.window(df, a, b, user_id=user_id)
+            self._add_rows(cents, counts, rows, self.categories.get_indexer(rows['category']))
+        return cents, counts
@@ -1,11 +1,58 @@
 import pandas as pd
 import numpy as np
+import contextlib
 import datetime
+import itertools
 import os
+from concurrent.futures import ProcessPoolExecutor
+
+import columnar
 
 START_OF_2019 = 1325376018 # UNIX TIME FOR JAN 1 2019 in dataset
 TIME_ADJUST_FACTOR = int(datetime.datetime(2019, 1, 1).timestamp()) - START_OF_2019
 
+SOURCE_PATH = "hf://datasets/pointe77/credit-card-transaction/credit_card_transaction_train.csv"
+CSV_PATH = os.path.join(os.path.dirname(__file__), "credit_card_transaction.csv")
+
+# Rows read from the source per chunk; memory use is bounded by the chunk, not the dataset
+CHUNK_ROWS = int(os.environ.get("DATASET_CHUNK_ROWS", 200_000))
+
+# Source columns the cleaned dataset is built from; everything else is never loaded
+SOURCE_COLUMNS = ['category', 'amt', 'first', 'last', 'gender', 'city', 'state', 'dob', 'unix_time']
+COLUMNS = ['category', 'amt', 'gender', 'city', 'state', 'unix_time', 'age', 'user_id', 'name', 'salary']
+NUMERIC_DTYPES = {'amt': 'float64', 'unix_time': 'int64', 'age': 'int64', 'salary': 'float64'}
+
+SALARY_SEED = 42
+
+# Synthetic data (see synthetic_chunks): category -> (share of transactions, median amt, lognormal sigma)
+SYNTHETIC_SEED = 2019
+SYNTHETIC_CATEGORIES = {
+    'gas_transport': (0.102, 64, 0.5), 'grocery': (0.130, 55, 0.8), 'home': (0.095, 45, 0.9),
+    'shopping': (0.165, 35, 1.2), 'kids_pets': (0.087, 30, 0.9), 'entertainment': (0.073, 30, 1.0),
+    'food_dining': (0.070, 25, 0.9), 'personal_care': (0.070, 20, 1.0), 'health_fitness': (0.066, 30, 0.8),
+    'misc': (0.111, 15, 1.3), 'travel': (0.031, 100, 1.4),
+}
+# state -> (share of users, cities)
+SYNTHETIC_STATES = {
+    'CA': (0.118, ['Los Angeles', 'San Diego', 'San Jose', 'San Francisco']), 'TX': (0.088, ['Houston', 'San Antonio', 'Dallas', 'Austin']),
+    'FL': (0.066, ['Jacksonville', 'Miami', 'Tampa']), 'NY': (0.059, ['New York', 'Buffalo', 'Rochester']),
+    'PA': (0.039, ['Philadelphia', 'Pittsburgh', 'Allentown']), 'IL': (0.038, ['Chicago', 'Aurora', 'Naperville']),
+    'OH': (0.035, ['Columbus', 'Cleveland', 'Cincinnati']), 'GA': (0.033, ['Atlanta', 'Augusta', 'Savannah']),
+    'NC': (0.032, ['Charlotte', 'Raleigh', 'Greensboro']), 'MI': (0.030, ['Detroit', 'Grand Rapids', 'Lansing']),
+    'NJ': (0.028, ['Newark', 'Jersey City', 'Paterson']), 'VA': (0.026, ['Virginia Beach', 'Richmond', 'Norfolk']),
+    'WA': (0.023, ['Seattle', 'Spokane', 'Tacoma']), 'AZ': (0.022, ['Phoenix', 'Tucson', 'Mesa']),
+    'MA': (0.021, ['Boston', 'Worcester', 'Springfield']),
+}
+SYNTHETIC_FIRST_NAMES = ['James', 'Mary', 'John', 'Patricia', 'Robert', 'Jennifer', 'Michael', 'Linda', 'David', 'Elizabeth',
+                         'William', 'Susan', 'Daniel', 'Jessica', 'Joseph', 'Sarah', 'Thomas', 'Karen', 'Minji', 'Jisoo']
+SYNTHETIC_LAST_NAMES = ['Smith', 'Johnson', 'Williams', 'Brown', 'Jones', 'Garcia', 'Miller', 'Davis', 'Rodriguez', 'Martinez',
+                        'Hernandez', 'Lopez', 'Wilson', 'Anderson', 'Thomas', 'Taylor', 'Moore', 'Kim', 'Lee', 'Park']
+SYNTHETIC_START = int(datetime.datetime(2019, 1, 1).timestamp())
+SYNTHETIC_END = int(datetime.datetime(2020, 6, 21).timestamp())
+
+# Fixed key for hashing user ids to partitions, so a user lands in the same partition in every process and run
+PARTITION_HASH_KEY = "cuayo-partition0"
+
 # set a seed for reproducibility
 np.random.seed(42)
 
@@ -16,79 +63,261 @@ def bring_dataset():
     #print(df.tail())
     return df
 
-def clean_dataset():
-    df = bring_dataset()
-    
-
-    # Remove unrelevant columns
-    df = df.drop(columns=['Unnamed: 0', 'cc_num','trans_date_trans_time', 'street', 'lat', 'long', 'merchant', 
-                          'city_pop', 'job', 'merch_lat', 'merch_long', 'zip', 'merch_zipcode', 'is_fraud', 'trans_num'])
-    
-    # Convert dobb to age in 2019
-    df['age'] = 2019 - pd.to_datetime(df['dob']).dt.year
-    df = df.drop(columns=['dob'])
-    
-    """# Write the cleaned dataset to a new CSV file
-    df.to_csv("credit_card_transaction.csv", index=False)"""
-
-    # Create user_id column
-    df['user_id'] = df['first'].str[0:2] + df['last'].str[0:2] + df['age'].astype(str)
-
-    # For each First Name + Last Name combination, 
-    # create a salary column with random values from 35k to 300k, rounding to nearest 1000
-    # Sample the random value from a normal distribution with mean 100k and std 50k, and clip the values to be between 35k and 300k
-    df['name'] = df['first'] + ' ' + df['last']
-    df = df.drop(columns=['first', 'last'])
-    salary_map = {}
-    for name in df['user_id'].unique():
-        salary = np.random.normal(100000, 50000)
-        salary = np.clip(salary, 40000, 300000)
-        salary = (salary / 1000).round() * 1000
-        salary_map[name] = salary
-    
-    df['salary'] = df['user_id'].map(salary_map)
-
-    # adjust time by TIME_ADJUST_FACTOR
-    df['unix_time'] = df['unix_time'] + TIME_ADJUST_FACTOR
-
-    # convert category column such that it drops _pos and _net suffixes
-    df['category'] = df['category'].str.replace('_pos', '')
-    df['category'] = df['category'].str.replace('_net', '')
-
-    df = df.dropna()
+def salary_for(user_ids, seed=SALARY_SEED):
+    """
+    Salary of each user id: a normal(100k, 50k) draw, clipped to 40k-300k and rounded to the nearest 1000.
+    The draw is taken from a hash of the user id instead of a global random stream, so a user gets the
+    same salary whichever chunk (or run) they appear in.
+
+    :param user_ids: array-like of user ids, NaN ids get a NaN salary
+    """
+    codes, uniques = pd.factorize(np.asarray(user_ids, dtype=object))
+    ids = np.asarray(uniques, dtype=object)
+    # Two independent uniforms in (0, 1) from the top 53 bits of two keyed hashes, then Box-Muller
+    u1 = ((pd.util.hash_array(ids, hash_key=f"salary{seed:010d}") >> np.uint64(11)) + 0.5) * 2.0 ** -53
+    u2 = ((pd.util.hash_array(ids, hash_key=f"income{seed:010d}") >> np.uint64(11)) + 0.5) * 2.0 ** -53
+    z = np.sqrt(-2 * np.log(u1)) * np.cos(2 * np.pi * u2)
+    salary = (np.clip(100000 + 50000 * z, 40000, 300000) / 1000).round() * 1000
+    return np.append(salary, np.nan)[codes]
+
+def clean_chunk(df):
+    """
+    Clean one chunk of the raw source. Every step is row-local (salary included), so cleaning
+    the source in chunks gives the same rows as cleaning it in one piece.
+    """
+    # Convert dob to age in 2019
+    age = 2019 - pd.to_datetime(df['dob']).dt.year
+
+    # user_id from the first two letters of the first and last name plus age
+    user_id = df['first'].str[0:2] + df['last'].str[0:2] + age.astype(str)
+
+    out = pd.DataFrame({
+        # drop the _pos and _net suffixes from category
+        'category': df['category'].str.replace('_pos', '').str.replace('_net', ''),
+        'amt': df['amt'],
+        'gender': df['gender'],
+        'city': df['city'],
+        'state': df['state'],
+        # adjust time by TIME_ADJUST_FACTOR
+        'unix_time': df['unix_time'] + TIME_ADJUST_FACTOR,
+        'age': age,
+        'user_id': user_id,
+        'name': df['first'] + ' ' + df['last'],
+        'salary': salary_for(user_id),
+    })
+    return conform(out.dropna())
+
+def conform(df):
+    """Put df in the cleaned dataset's column order and dtypes, so chunks write identically."""
+    return df[COLUMNS].astype(NUMERIC_DTYPES).reset_index(drop=True)
+
+def iter_clean_chunks(source=SOURCE_PATH, chunksize=CHUNK_ROWS):
+    """Read the raw source chunksize rows at a time and yield each chunk cleaned."""
+    for chunk in pd.read_csv(source, usecols=SOURCE_COLUMNS, chunksize=chunksize):
+        yield clean_chunk(chunk)
+
+def clean_dataset(source=SOURCE_PATH, chunksize=CHUNK_ROWS):
+    df = pd.concat(iter_clean_chunks(source, chunksize), ignore_index=True)
 
     # Print column names of df
     print(df.columns)
 
     return df
 
-def create_eugene_dataset():
-    df = clean_dataset()
+def eugene_rows():
     categories = ['food_dining', 'travel', 'entertainment', 'personal_care', 'grocery', 'health_fitness', 'kids_pets', 'misc', 'gas_transport', 'home', 'shopping']
-    new_rows = []
     start_2019_unix = int(datetime.datetime(2019, 1, 1).timestamp())
     end_time_unix = int(datetime.datetime(2020, 6, 21).timestamp())
-    for _ in range(1000):
-        category = np.random.choice(categories)
-        unix_time = np.random.randint(start_2019_unix, end_time_unix)
-        # Round amt to 2 digits after decimal
-        amt = np.random.normal(25, 100)
-        amt = round(amt, 2)
-        amt = np.clip(amt, 5, 500)
-        new_row = {'user_id': 'EuLe21', 'category': category, 'unix_time': unix_time, 'amt': amt, 'state': 'PA', 'salary': 60000,
-                   'gender': 'M', 'name': 'Eugene Lee', 'age': 21, 'city': 'Pittsburgh'}
-        new_rows.append(new_row)
-    
-    # Combine df and new_rows into a new dataframe and return it
-    new_df = pd.concat([df, pd.DataFrame(new_rows)], ignore_index=True)
+    n = 1000
+    # Round amt to 2 digits after decimal
+    new_rows = pd.DataFrame({'user_id': 'EuLe21', 'category': np.random.choice(categories, n),
+                             'unix_time': np.random.randint(start_2019_unix, end_time_unix, n),
+                             'amt': np.clip(np.random.normal(25, 100, n).round(2), 5, 500), 'state': 'PA', 'salary': 60000,
+                             'gender': 'M', 'name': 'Eugene Lee', 'age': 21, 'city': 'Pittsburgh'})
+    return conform(new_rows)
+
+def synthetic_users(rng, first_user, n):
+    """Profiles of the synthetic users first_user .. first_user + n - 1, one row per user."""
+    states = list(SYNTHETIC_STATES)
+    weights = np.array([SYNTHETIC_STATES[s][0] for s in states])
+    state = rng.choice(len(states), n, p=weights / weights.sum())
+    # Pick a city of each user's state from the flattened city list
+    cities = [SYNTHETIC_STATES[s][1] for s in states]
+    sizes = np.array([len(c) for c in cities])
+    offsets = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+    city = np.concatenate(cities)[offsets[state] + (rng.random(n) * sizes[state]).astype(np.int64)]
+    first = rng.choice(SYNTHETIC_FIRST_NAMES, n)
+    last = rng.choice(SYNTHETIC_LAST_NAMES, n)
+    user_id = np.char.add("Sy", np.char.zfill(np.arange(first_user, first_user + n).astype(str), 7))
+    return pd.DataFrame({
+        'gender': rng.choice(['F', 'M'], n),
+        'city': city,
+        'state': np.array(states)[state],
+        'age': np.clip(rng.normal(45, 17, n), 18, 95).astype(np.int64),
+        'user_id': user_id,
+        'name': np.char.add(np.char.add(first, ' '), last),
+        'salary': salary_for(user_id),
+    })
+
+def synthetic_rows(rng, users, counts):
+    """counts[i] random transactions of users.iloc[i], drawn with the SYNTHETIC_* distributions."""
+    owner = np.repeat(np.arange(len(users)), counts)
+    m = len(owner)
+    categories = list(SYNTHETIC_CATEGORIES)
+    weight, median, sigma = (np.array([SYNTHETIC_CATEGORIES[c][k] for c in categories]) for k in range(3))
+    category = rng.choice(len(categories), m, p=weight / weight.sum())
+    amt = np.clip(rng.lognormal(np.log(median[category]), sigma[category]), 1, 10000).round(2)
+    rows = users.iloc[owner].reset_index(drop=True)
+    rows['category'] = np.array(categories)[category]
+    rows['amt'] = amt
+    rows['unix_time'] = rng.integers(SYNTHETIC_START, SYNTHETIC_END, m)
+    return conform(rows)
+
+def synthetic_chunks(users, transactions, seed=SYNTHETIC_SEED, chunksize=CHUNK_ROWS):
+    """
+    Yield a synthetic dataset of `users` users and about `transactions` transactions in total,
+    in cleaned chunks of about chunksize rows, so it can be streamed with write_chunks at any size.
+    Users get ids Sy0000000, Sy0000001, ..., salaries from salary_for and a random activity level
+    that sets their share of the transactions. The output depends only on the arguments.
+    """
+    per_user = max(transactions / max(users, 1), 1)
+    chunk_users = max(1, int(chunksize / per_user))
+    for first_user in range(0, users, chunk_users):
+        n = min(chunk_users, users - first_user)
+        rng = np.random.default_rng([seed, first_user])
+        # This chunk's share of the transactions, spread over its users by activity
+        total = transactions * (first_user + n) // users - transactions * first_user // users
+        activity = rng.gamma(2.0, size=n)
+        counts = rng.multinomial(total, activity / activity.sum())
+        yield synthetic_rows(rng, synthetic_users(rng, first_user, n), counts)
+
+def create_eugene_dataset(source=SOURCE_PATH, chunksize=CHUNK_ROWS):
+    df = clean_dataset(source, chunksize)
+    # Combine df and the new rows into a new dataframe and return it
+    new_df = pd.concat([df, eugene_rows()], ignore_index=True)
     return new_df
 
-def write_df(df):
-    csv_path = os.path.join(os.path.dirname(__file__), "credit_card_transaction.csv")
+def write_chunks(chunks, csv_path=CSV_PATH, csv=True):
+    """
+    Write a stream of cleaned chunks to csv_path and its columnar copy as they arrive,
+    one columnar part per chunk. Both files are replaced only once the stream is done.
+
+    :param csv: if False, write only the columnar copy (the query layer reads it over the CSV)
+    :return: number of rows written
+    """
+    tmp = csv_path + ".tmp"
+    table = columnar.TableWriter(columnar.table_path(csv_path))
+    with open(tmp, "w", newline="", encoding="utf-8") if csv else contextlib.nullcontext() as f:
+        for i, chunk in enumerate(chunks):
+            if csv:
+                chunk.to_csv(f, index=False, header=(i == 0))
+            table.write(chunk)
+    table.close()
+    if csv:
+        os.replace(tmp, csv_path)
+    return table.rows
+
+def prepare_dataset(source=SOURCE_PATH, csv_path=CSV_PATH, chunksize=CHUNK_ROWS):
+    """Clean the source chunk by chunk, add Eugene's rows, and stream everything to csv_path."""
+    return write_chunks(itertools.chain(iter_clean_chunks(source, chunksize), [eugene_rows()]), csv_path)
+
+def partition_of(user_ids, partitions):
+    """Partition number (0 .. partitions - 1) of each user id."""
+    hashed = pd.util.hash_array(np.asarray(user_ids, dtype=object), hash_key=PARTITION_HASH_KEY)
+    return (hashed % np.uint64(partitions)).astype(np.int64)
+
+def write_partitions(df, chunk, partitions, table_dir):
+    """
+    Split a cleaned chunk by partition_of(user_id) and write every non-empty piece as
+    the columnar part part-<partition>-<chunk> under table_dir.
+
+    :return: list of (partition, part name, column kinds, rows)
+    """
+    keys = partition_of(df['user_id'], partitions)
+    written = []
+    for p in np.unique(keys):
+        name = f"part-{p:05d}-{chunk:05d}"
+        piece = df[keys == p].reset_index(drop=True)
+        written.append((int(p), name, columnar.write_part(piece, os.path.join(table_dir, name)), len(piece)))
+    return written
+
+def _clean_partitioned(raw, chunk, partitions, table_dir):
+    return write_partitions(clean_chunk(raw), chunk, partitions, table_dir)
+
+def prepare_parallel(source=SOURCE_PATH, csv_path=CSV_PATH, chunksize=CHUNK_ROWS, workers=None, partitions=None):
+    """
+    prepare_dataset on a process pool. The source is read in chunks and each chunk is cleaned
+    in a worker, which hash-partitions its rows by user_id and writes one columnar part per
+    partition. The result is the columnar table next to csv_path (no CSV), with its parts grouped
+    by partition: every user's rows sit in one partition, which read_table(..., partitions=[p]) loads on
+    its own. The rows are the same as prepare_dataset's (salaries included); within a partition
+    they keep source order.
+
+    :param workers: worker processes, os.cpu_count() if None
+    :param partitions: number of partitions, workers if None
+    :return: number of rows written
+    """
+    workers = workers or os.cpu_count() or 1
+    partitions = partitions or workers
+    table = columnar.TableWriter(columnar.table_path(csv_path))
+    written = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = []
+        i = -1
+        chunks = pd.read_csv(source, usecols=SOURCE_COLUMNS, chunksize=chunksize)
+        for i, raw in enumerate(chunks):
+            pending.append(pool.submit(_clean_partitioned, raw, i, partitions, table.data_dir))
+            # Keep at most two chunks per worker in flight, so memory stays bounded
+            while len(pending) >= 2 * workers:
+                written += pending.pop(0).result()
+        for future in pending:
+            written += future.result()
+        # Eugene's rows use the global random stream, so they are drawn here rather than in a worker
+        written += write_partitions(eugene_rows(), i + 1, partitions, table.data_dir)
+
+    layout = [[] for _ in range(partitions)]
+    for p, name, kinds, rows in sorted(written, key=lambda w: w[1]):
+        table.add_part(name, kinds, rows)
+        layout[p].append(name)
+    table.meta.update(partition_key="user_id", partitions=layout)
+    table.close()
+    return table.rows
+
+def write_df(df, csv_path=CSV_PATH):
     df.to_csv(csv_path, index=False)
+    # Columnar copy next to the CSV; rank_generator reads it when present
+    columnar.write_table(df, columnar.table_path(csv_path))
 
 
 if __name__ == "__main__":
-    df = create_eugene_dataset()
-    write_df(df)
-    print(df[df['user_id'] == 'EuLe21'].head())
\ No newline at end of file
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--convert", nargs="?", const=CSV_PATH,
+                        default=None, metavar="CSV_PATH",
+                        help="convert an existing transaction CSV to the columnar format and exit")
+    parser.add_argument("--source", type=str, default=SOURCE_PATH, help="raw transaction CSV to prepare")
+    parser.add_argument("--output", type=str, default=CSV_PATH)
+    parser.add_argument("--chunksize", type=int, default=CHUNK_ROWS, help="source rows per chunk")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="worker processes; above 1, write a columnar table partitioned by user_id")
+    parser.add_argument("--partitions", type=int, default=None, help="number of partitions, --workers if omitted")
+    parser.add_argument("--synthetic", type=int, nargs=2, default=None, metavar=("USERS", "TRANSACTIONS"),
+                        help="write a synthetic dataset (plus Eugene's rows) instead of preparing the source")
+    parser.add_argument("--seed", type=int, default=SYNTHETIC_SEED, help="seed of the synthetic dataset")
+    parser.add_argument("--no_csv", action="store_true", help="with --synthetic, write only the columnar table")
+    args = parser.parse_args()
+
+    if args.convert:
+        print(columnar.convert_csv(args.convert))
+    elif args.synthetic:
+        users, transactions = args.synthetic
+        chunks = itertools.chain([eugene_rows()], synthetic_chunks(users, transactions, args.seed, args.chunksize))
+        rows = write_chunks(chunks, args.output, csv=not args.no_csv)
+        print(f"wrote {rows} synthetic rows to {columnar.table_path(args.output) if args.no_csv else args.output}")
+    elif args.workers > 1:
+        rows = prepare_parallel(args.source, args.output, args.chunksize, args.workers, args.partitions)
+        print(f"wrote {rows} rows to {columnar.table_path(args.output)}")
+    else:
+        rows = prepare_dataset(args.source, args.output, args.chunksize)
+        print(f"wrote {rows} rows to {args.output}")
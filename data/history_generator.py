@@ -1,9 +1,12 @@
 import numpy as np
 import pandas as pd
 import datetime
-import os
 
-from rank_generator import search_df
+from dateutil import tz
+
+from daily_aggregates import to_cents
+from leaderboard import RATIO_SCALE, WINDOW_DAYS, spent_ratio
+from transaction_store import get_store
 
 def generate_history(user_id, category, timeframe, ref_time, n=10):
     """
@@ -28,51 +31,73 @@ def generate_history(user_id, category, timeframe, ref_time, n=10):
     Spend Ratio is the ratio of the user's spend in the category to the average spend in that category for the given timeframe.
     Spen Raw contains each individual transaction
     """
-    df = pd.read_csv(os.path.join(os.path.dirname(__file__), "credit_card_transaction.csv"))
+    if timeframe not in WINDOW_DAYS:
+        raise ValueError("Invalid timeframe. Must be one of 'd', 'w', or 'm'.")
+    index, df = get_store().time_index()
+    # Same check as search_df
+    if user_id not in get_store().users():
+        raise ValueError("user_id not found in dataset. Please check the user_id and try again.")
     rank_history = {}
     spend_ratio_history = {}
     spend_raw_history = {}
-    for i in range(n):
-        #print(f"Generating history for timeframe {i+1}/{n}...")
-        if timeframe == "d":
-            end_time = ref_time - datetime.timedelta(days=i)
-        elif timeframe == "w":
-            end_time = ref_time - datetime.timedelta(weeks=i)
-        elif timeframe == "m":
-            end_time = ref_time - datetime.timedelta(days=30*i)
-            #print(ref_time)
-            #print(end_time)
-        else:
-            raise ValueError("Invalid timeframe. Must be one of 'd', 'w', or 'm'.")
-        #print(search_df(user_id, category, timeframe, end_time))
-        user_spent_ratio, user_rank, _, _, _ = search_df(user_id, category, timeframe, end_time)
-        if user_rank is not None and user_rank > 0:
-            rank_history[end_time.strftime("%Y-%m-%d")] = user_rank
-        if user_spent_ratio is not None and user_spent_ratio > 0:
-            spend_ratio_history[end_time.strftime("%Y-%m-%d")] = user_spent_ratio
-        
-        # Get raw spend for the user in the category for the timeframe
-        df = df[df['category'] == category]
-        df = df[df['user_id'] == user_id]
-        df = df[df['unix_time'] <= int(end_time.timestamp())]
+    if n <= 0:
+        return {"rank_history": rank_history, "spend_ratio_history": spend_ratio_history, "spend_raw_history": spend_raw_history}
+
+    # Window i ends i timeframes before ref_time. Rank windows are [end - days, end] in unix
+    # time (as in search_df), raw spend windows [end - timeframe, end] in local time
+    step = datetime.timedelta(days=WINDOW_DAYS[timeframe])
+    end_times = [ref_time - step * i for i in range(n)]
+    dates = [end_time.strftime("%Y-%m-%d") for end_time in end_times]
+    ends = np.array([int(end_time.timestamp()) for end_time in end_times], dtype=np.int64)
+    rank_starts = ends - WINDOW_DAYS[timeframe] * 86400
+    raw_starts = np.array([int((end_time - step).timestamp()) for end_time in end_times], dtype=np.int64)
+
+    # One slice of the category covering all n windows, in table order
+    lo = int(min(rank_starts.min(), raw_starts.min()))
+    hi = int(ends.max())
+    rows = index.window(df, lo, hi, category=category)
+    times = rows['unix_time'].to_numpy(dtype=np.int64)
+    codes, users = pd.factorize(rows['user_id'])
+    salary = rows['salary'].to_numpy(dtype=np.float64)[np.unique(codes, return_index=True)[1]]
+
+    # Spend of every user in every window from prefix sums over the slice sorted by (user, time)
+    span = hi - lo + 1
+    order = np.lexsort((times, codes))
+    keys = codes[order].astype(np.int64) * span + (times[order] - lo)
+    cum_cents = np.concatenate([[0], np.cumsum(to_cents(rows['amt'].to_numpy())[order])])
+    user_base = np.arange(len(users), dtype=np.int64)[:, None] * span
+    a = np.searchsorted(keys, user_base + (rank_starts - lo), side='left')
+    b = np.searchsorted(keys, user_base + (ends - lo), side='right')
+    active = b > a
+    # Same quantized spent_ratio as the leaderboards, so ranks match search_df ('min' ties)
+    ratio_keys = np.rint(spent_ratio(cum_cents[b] - cum_cents[a], salary[:, None], timeframe) * RATIO_SCALE).astype(np.int64)
+
+    u = users.get_indexer([user_id])[0] if len(users) else -1
+    if u >= 0:
+        user_keys = ratio_keys[u]
+        ranks = 1 + np.sum(active & (ratio_keys < user_keys), axis=0)
+        for i in np.flatnonzero(active[u]):
+            rank_history[dates[i]] = int(ranks[i])
+            if user_keys[i] > 0:
+                spend_ratio_history[dates[i]] = user_keys[i] / RATIO_SCALE
+
+    # Raw transactions of the user, with timestamps converted to local datetimes in one call
+    mine = rows.iloc[np.flatnonzero(codes == u)] if u >= 0 else rows.iloc[:0]
+    mine_times = mine['unix_time'].to_numpy(dtype=np.int64)
+    stamps = (pd.to_datetime(mine_times, unit='s', utc=True).tz_convert(tz.tzlocal())
+              .tz_localize(None).to_pydatetime())
+    amts = mine['amt'].to_numpy()
+    in_window = (mine_times >= raw_starts[:, None]) & (mine_times <= ends[:, None])
+    for i, date in enumerate(dates):
+        m = in_window[i]
+        spend_raw_history[date] = list(zip(stamps[m].tolist(), amts[m].tolist()))
 
-        if timeframe == "d":
-            start_time = end_time - datetime.timedelta(days=1)
-        elif timeframe == "w":
-            start_time = end_time - datetime.timedelta(weeks=1)
-        elif timeframe == "m":
-            start_time = end_time - datetime.timedelta(days=30)
-        #print(start_time, end_time)
-        df = df[df['unix_time'] >= int(start_time.timestamp())]
-        spend_raw_history[end_time.strftime("%Y-%m-%d")] = list(zip(df['unix_time'].apply(lambda x: datetime.datetime.fromtimestamp(x)), df['amt']))
-    
     return {
         "rank_history": rank_history,
         "spend_ratio_history": spend_ratio_history,
         "spend_raw_history": spend_raw_history
     }
 
-
 if __name__ == "__main__":
     user_id = "EuLe21"
     category = "gas_transport"
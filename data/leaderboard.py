@@ -0,0 +1,544 @@
+import bisect
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+import columnar
+from daily_aggregates import to_cents
+
+# spent_ratio is rounded to 4 decimals, so ratio * 10000 is an exact integer bucket
+RATIO_SCALE = 10000
+
+# Length of the d / w / m time windows in days
+WINDOW_DAYS = {'d': 1, 'w': 7, 'm': 30}
+
+# Salary divisor per time window (same as search_df)
+SALARY_RATIO = {'m': 12, 'w': 52}
+
+# Boards (and their ranked tables) kept warm by the engine
+MAX_BOARDS = int(os.getenv("LEADERBOARD_CACHE_SIZE", "256"))
+
+# Leaderboard slice returned by search: top K users and NEIGHBOR_RADIUS users on each side of the caller
+TOP_K = int(os.getenv("LEADERBOARD_TOP_K", "3"))
+NEIGHBOR_RADIUS = int(os.getenv("LEADERBOARD_RADIUS", "1"))
+
+# A batch of appended rows touching more than this fraction of a board's users drops the
+# board (rebuilt from the daily aggregates on next use) instead of updating it user by user
+REBUILD_FRACTION = float(os.getenv("LEADERBOARD_REBUILD_FRACTION", "0.25"))
+
+# Columns of a leaderboard table (Leaderboard.table)
+TABLE_COLUMNS = ['user_id', 'name', 'amt', 'salary', 'spent_ratio', 'rank', 'percentile']
+
+
+def materialized_path(csv_path):
+    """Return the directory of materialized leaderboard tables that sits next to csv_path."""
+    root, _ = os.path.splitext(csv_path)
+    return root + "_leaderboards"
+
+
+def window_bounds(time, ref_unix):
+    """(start, end) unix bounds of the time window ending at ref_unix; (None, None) if time is not d / w / m."""
+    days = WINDOW_DAYS.get(time)
+    if days is None:
+        return None, None
+    return ref_unix - days * 86400, ref_unix
+
+
+def salary_ratio(time):
+    return SALARY_RATIO.get(time, 365)
+
+
+def spent_ratio(cents, salary, time):
+    """spent_ratio = amt / (salary / salary_ratio), rounded to 4 decimals (as in search_df)."""
+    return np.round(np.asarray(cents) / 100 / (np.asarray(salary, dtype=np.float64) / salary_ratio(time)), 4)
+
+
+def ratio_keys(cents, salary, time):
+    """Quantized spent_ratio (spent_ratio * RATIO_SCALE as an exact integer) used to rank users."""
+    return np.rint(spent_ratio(cents, salary, time) * RATIO_SCALE).astype(np.int64)
+
+
+def _smallest(values, positions, m):
+    """positions of the m smallest values, in increasing order of value, without sorting all values."""
+    if m <= 0 or len(values) == 0:
+        return []
+    if m < len(values):
+        part = np.argpartition(values, m - 1)[:m]
+    else:
+        part = np.arange(len(values))
+    return positions[part[np.argsort(values[part])]].tolist()
+
+
+def rank_slice(keys, position=None, k=TOP_K, radius=NEIGHBOR_RADIUS):
+    """
+    Rank, top-k and neighbors of one entry of an unsorted array of ratio keys in O(n):
+    counting comparisons and np.argpartition instead of a full sort. Ties are ordered by
+    position, the same order a Leaderboard built from the array uses.
+
+    :param keys: ratio keys (see ratio_keys), one per user
+    :param position: position of the caller in keys, or None
+    :return: (rank, num_users, top, before, after) where rank is the caller's 'min' rank (None if
+             position is None), num_users the number of keys > 0, top the positions of the first k
+             users, before / after the positions of the radius users ranked right before / after
+             the caller, all in ranking order
+    """
+    keys = np.asarray(keys, dtype=np.int64)
+    n = len(keys)
+    # unique sort key: (ratio key, position)
+    order = keys * max(n, 1) + np.arange(n)
+    positions = np.arange(n)
+    num_users = int(np.count_nonzero(keys > 0))
+    top = _smallest(order, positions, k)
+    if position is None:
+        return None, num_users, top, [], []
+    key = keys[position]
+    lower = np.flatnonzero(keys < key)
+    higher = np.flatnonzero(keys > key)
+    before = _smallest(-order[lower], lower, radius)[::-1]
+    after = _smallest(order[higher], higher, radius)
+    return len(lower) + 1, num_users, top, before, after
+
+
+def slice_result(user, user_rank, num_users, top, before, after, name, ratio, rank, k=TOP_K, ranks=False):
+    """
+    Assemble search_df's (user_spent_ratio, user_rank, num_users, top_users, top_spent_ratios)
+    from a leaderboard slice: the top k users plus, when the caller ranks below k, the users
+    right before it, the caller and the users right after it (skipping names already listed).
+
+    :param user: the caller, or None if it has no transactions in the window
+    :param name / ratio / rank: lookups from a user (as found in top / before / after) to its
+                                name, spent_ratio and rank
+    :param ranks: if True, append the rank of every listed user as a sixth element
+    """
+    if user is None:
+        rows = list(top)
+    elif user_rank <= k:
+        # User is in the top k: keep the first k rows but make sure the user appears (replace if tied)
+        rows = sorted([u for u in top if u != user] + [user], key=rank)[:k]
+    else:
+        rows = list(top)
+        listed = {name(u) for u in top}
+        for u in (*before, user, *after):
+            if name(u) not in listed:
+                listed.add(name(u))
+                rows.append(u)
+    result = (0 if user is None else ratio(user), user_rank, num_users, [name(u) for u in rows], [ratio(u) for u in rows])
+    return result + ([rank(u) for u in rows],) if ranks else result
+
+
+class FenwickTree:
+    """Counts per integer bucket with O(log n) point updates, prefix counts and k-th element lookup."""
+
+    def __init__(self, counts):
+        counts = np.asarray(counts, dtype=np.int64)
+        size = 1
+        while size < len(counts) + 1:
+            size *= 2
+        padded = np.zeros(size + 1, dtype=np.int64)
+        padded[1:len(counts) + 1] = counts
+        prefix = np.cumsum(padded)
+        i = np.arange(1, size + 1)
+        # tree[i] holds the count of buckets (i - lowbit(i), i]
+        self.tree = np.zeros(size + 1, dtype=np.int64)
+        self.tree[1:] = prefix[i] - prefix[i - (i & -i)]
+        self.tree = self.tree.tolist()
+        self.size = size
+
+    def grow(self, min_size):
+        counts = [self.prefix(i + 1) - self.prefix(i) for i in range(self.size)]
+        self.__init__(counts + [0] * (min_size - self.size))
+
+    def add(self, bucket, delta):
+        if bucket < 0:
+            raise ValueError(f"negative bucket {bucket}")
+        if bucket >= self.size:
+            self.grow(bucket + 1)
+        i = bucket + 1
+        while i <= self.size:
+            self.tree[i] += delta
+            i += i & -i
+
+    def prefix(self, bucket):
+        """Number of elements in buckets [0, bucket)."""
+        i = min(bucket, self.size)
+        total = 0
+        while i > 0:
+            total += self.tree[i]
+            i -= i & -i
+        return total
+
+    def kth(self, k):
+        """Bucket holding the k-th smallest element (0-based)."""
+        pos = 0
+        step = self.size
+        while step:
+            nxt = pos + step
+            if nxt <= self.size and self.tree[nxt] <= k:
+                pos = nxt
+                k -= self.tree[nxt]
+            step //= 2
+        return pos
+
+
+class Leaderboard:
+    """
+    Ranking of the users of one (category, time, ref_time, state) by spent_ratio.
+
+    Users are bucketed by quantized spent_ratio in a Fenwick tree, so rank lookups
+    ('min' tie semantics: 1 + number of users with a lower spent_ratio), k-th place and
+    neighbor lookups, and updates when a transaction arrives are all O(log n).
+
+    Refunds can take a user's total below zero: negative keys are kept out of the tree in
+    a sorted list (self.negative) and ranked ahead of it, so such users still rank first.
+    """
+
+    def __init__(self, time, user_ids, cents, salary, names):
+        self.time = time
+        self.cents = dict(zip(user_ids, (int(c) for c in cents)))
+        self.salary = dict(zip(user_ids, (float(s) for s in salary)))
+        self.names = dict(zip(user_ids, names))
+        keys = self._keys(np.asarray(cents), np.asarray(salary, dtype=np.float64))
+        self.keys = dict(zip(user_ids, keys.tolist()))
+        # users in each bucket, in insertion order
+        self.buckets = {}
+        for user, key in self.keys.items():
+            self.buckets.setdefault(key, []).append(user)
+        self.negative = np.sort(keys[keys < 0]).tolist()
+        self.tree = FenwickTree(np.bincount(keys[keys >= 0], minlength=1))
+        # bumped on every add, so results derived from the board can tell they are stale
+        self.version = 0
+
+    def _keys(self, cents, salary):
+        return ratio_keys(cents, salary, self.time)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def ratio(self, user_id):
+        return self.keys[user_id] / RATIO_SCALE
+
+    def below(self, key):
+        """Number of users with a ratio key lower than key."""
+        if key <= 0:
+            return bisect.bisect_left(self.negative, key)
+        return len(self.negative) + self.tree.prefix(key)
+
+    def rank(self, user_id):
+        return self.below(self.keys[user_id]) + 1
+
+    def nonzero(self):
+        """Number of users with spent_ratio > 0."""
+        return len(self.keys) - self.below(1)
+
+    def at(self, position):
+        """User at 0-based position in ranking order (ties in insertion order)."""
+        if position < len(self.negative):
+            key = self.negative[position]
+        else:
+            key = self.tree.kth(position - len(self.negative))
+        return self.buckets[key][position - self.below(key)]
+
+    def add(self, user_id, cents, salary=None, name=None):
+        """Add cents of spend to user_id (inserting the user if new) and re-bucket it."""
+        old = self.keys.get(user_id)
+        if old is not None:
+            if old < 0:
+                del self.negative[bisect.bisect_left(self.negative, old)]
+            else:
+                self.tree.add(old, -1)
+            self.buckets[old].remove(user_id)
+            if not self.buckets[old]:
+                del self.buckets[old]
+        else:
+            self.salary[user_id] = float(salary)
+            self.names[user_id] = name
+        self.cents[user_id] = self.cents.get(user_id, 0) + int(cents)
+        key = int(self._keys(np.array([self.cents[user_id]]), np.array([self.salary[user_id]]))[0])
+        self.keys[user_id] = key
+        self.buckets.setdefault(key, []).append(user_id)
+        if key < 0:
+            bisect.insort(self.negative, key)
+        else:
+            self.tree.add(key, 1)
+        self.version += 1
+
+    def table(self):
+        """
+        Every user on the board in ranking order (ties in the order search() uses).
+        :return: DataFrame with TABLE_COLUMNS, where percentile is rank / num_users * 100
+                 (the rankings page's "Top x%"), NaN if no user has spent
+        """
+        users = [u for key in sorted(self.buckets) for u in self.buckets[key]]
+        keys = np.array([self.keys[u] for u in users], dtype=np.int64)
+        # 'min' ties: 1 + number of users in lower buckets, i.e. 1 + position of the bucket's first user
+        rank = np.searchsorted(keys, keys, side='left') + 1
+        num_users = self.nonzero()
+        return pd.DataFrame({
+            'user_id': users,
+            'name': [self.names[u] for u in users],
+            'amt': np.array([self.cents[u] for u in users], dtype=np.int64) / 100,
+            'salary': np.array([self.salary[u] for u in users], dtype=np.float64),
+            'spent_ratio': keys / RATIO_SCALE,
+            'rank': rank,
+            'percentile': rank / num_users * 100 if num_users else np.full(len(users), np.nan),
+        }, columns=TABLE_COLUMNS)
+
+    def search(self, user_id, k=TOP_K, radius=NEIGHBOR_RADIUS, ranks=False):
+        """
+        Same contract as search_df: (user_spent_ratio, user_rank, num_users, top_users, top_spent_ratios),
+        with the top k users plus the radius users right before and after user_id when it ranks below k,
+        and the rank of each listed user if ranks is True.
+        """
+        n = len(self.keys)
+        if n == 0:
+            return (0, None, None, [], []) + (([],) if ranks else ())
+        top = [self.at(i) for i in range(min(k, n))]
+        if user_id not in self.keys:
+            return slice_result(None, None, self.nonzero(), top, [], [], self.names.get, self.ratio, self.rank, k, ranks)
+        key = self.keys[user_id]
+        # right before: last users with a lower spent_ratio; right after: first users with a higher one
+        below = self.below(key)
+        above = self.below(key + 1)
+        before = [self.at(i) for i in range(max(below - radius, 0), below)]
+        after = [self.at(i) for i in range(above, min(above + radius, n))]
+        return slice_result(user_id, below + 1, self.nonzero(), top, before, after,
+                            self.names.get, self.ratio, self.rank, k, ranks)
+
+
+class LeaderboardEngine:
+    """
+    Leaderboards kept warm per (category, time, ref_unix, state) and updated in place as
+    transactions are appended to the store, instead of being re-ranked on every request.
+
+    Boards live in an LRU of max_boards entries. Ranked tables (Leaderboard.table) are cached
+    per key together with the board version they were made from: appended rows only bump the
+    version of the boards whose category / window / state they fall in, so every other cached
+    table stays valid. A full reload of the store drops everything.
+    """
+
+    def __init__(self, store, max_boards=MAX_BOARDS):
+        self.store = store
+        self.max_boards = max_boards
+        self.boards = OrderedDict()
+        # key -> (board, board version, ranked table)
+        self.tables = OrderedDict()
+        # keys requested once and answered without a board (see search)
+        self._seen = OrderedDict()
+        self.counters = dict.fromkeys(
+            ['hits', 'misses', 'evictions', 'table_hits', 'table_misses', 'rows_applied', 'invalidations'], 0)
+        self._lock = threading.RLock()
+        store.subscribe(self.on_rows)
+
+    def table_path(self, category, time, ref_unix, state):
+        return os.path.join(materialized_path(self.store.path), str(ref_unix), f"{category}-{time}-{state or 'all'}")
+
+    def load_table(self, category, time, ref_unix, state):
+        """Materialized table for the key, or None if there is none or it predates the loaded data."""
+        path = self.table_path(category, time, ref_unix, state)
+        if not columnar.exists(path) or columnar.read_meta(path).get("source") != self.store.fingerprint():
+            return None
+        return columnar.read_table(path, mmap=False)
+
+    def totals(self, category, time, ref_unix, state):
+        """
+        Window spend of every user with transactions for the key, from the materialized table if it is current.
+        :return: (user_ids, cents, salary, names), in the order users are inserted into a board
+        """
+        aggregates, index, df = self.store.aggregates()
+        table = self.load_table(category, time, ref_unix, state)
+        if table is not None:
+            return (pd.Index(table['user_id'].astype(object)), to_cents(table['amt']),
+                    table['salary'].to_numpy(dtype=np.float64), table['name'].to_numpy(dtype=object))
+        start, end = window_bounds(time, ref_unix)
+        if state is None:
+            cents, counts = aggregates.category_totals(df, index, category, start, end)
+            active = counts > 0
+            return aggregates.users[active], cents[active], aggregates.salary[active], aggregates.names[active]
+        rows = index.window(df, start, end, category=category)
+        rows = rows[rows['state'] == state]
+        cents = rows.assign(cents=to_cents(rows['amt'])).groupby('user_id', observed=True, sort=False)['cents'].sum()
+        user_ids = pd.Index(cents.index.astype(object))
+        info = self.store.users().gather(user_ids, ['salary', 'name'])
+        return (user_ids, cents.to_numpy(dtype=np.int64),
+                info['salary'].to_numpy(dtype=np.float64), info['name'].to_numpy(dtype=object))
+
+    def build(self, category, time, ref_unix, state):
+        user_ids, cents, salary, names = self.totals(category, time, ref_unix, state)
+        return Leaderboard(time, list(user_ids), cents, salary, list(names))
+
+    def board(self, category, time, ref_unix, state=None):
+        """Return the leaderboard for the key, building it on first use."""
+        key = (category, time, ref_unix, state)
+        # Build under the store lock so no appended rows are missed between build and registration
+        with self.store.lock, self._lock:
+            # Pick up appended rows first (applied to the cached boards by on_rows)
+            self.store.df
+            board = self.boards.get(key)
+            if board is None:
+                self.counters['misses'] += 1
+                board = self.build(category, time, ref_unix, state)
+                self.boards[key] = board
+                while len(self.boards) > self.max_boards:
+                    evicted, _ = self.boards.popitem(last=False)
+                    self.tables.pop(evicted, None)
+                    self.counters['evictions'] += 1
+            else:
+                self.counters['hits'] += 1
+                self.boards.move_to_end(key)
+            self._seen.pop(key, None)
+            return board
+
+    def search(self, user_id, category, time, ref_unix, state=None, k=TOP_K, radius=NEIGHBOR_RADIUS, ranks=False):
+        """
+        search_df for one user. The first request for a key is answered with rank_slice over the
+        window totals (O(n), no board); a board is built once the key is requested again.
+        With ranks=True, the rank of every listed user is appended (see slice_result).
+        """
+        key = (category, time, ref_unix, state)
+        with self.store.lock, self._lock:
+            if key in self.boards or key in self._seen:
+                return self.board(category, time, ref_unix, state).search(user_id, k, radius, ranks)
+            self.counters['misses'] += 1
+            self._seen[key] = None
+            while len(self._seen) > self.max_boards:
+                self._seen.popitem(last=False)
+            user_ids, cents, salary, names = self.totals(category, time, ref_unix, state)
+        if len(user_ids) == 0:
+            return (0, None, None, [], []) + (([],) if ranks else ())
+        keys = ratio_keys(cents, salary, time)
+        position = user_ids.get_indexer([user_id])[0]
+        position = None if position < 0 else int(position)
+        user_rank, num_users, top, before, after = rank_slice(keys, position, k, radius)
+        top_ranks = {p: r for p, r in zip(top, np.searchsorted(keys[top], keys[top], side='left') + 1)}
+
+        def rank(p):
+            if p == position:
+                return user_rank
+            if p in top_ranks:
+                return int(top_ranks[p])
+            return int(np.count_nonzero(keys < keys[p])) + 1
+
+        return slice_result(position, user_rank, num_users, top, before, after,
+                            lambda p: names[p], lambda p: keys[p] / RATIO_SCALE, rank, k, ranks)
+
+    def table(self, category, time, ref_unix, state=None):
+        """
+        Every user's spent_ratio, rank and percentile for the key (see Leaderboard.table).
+        The table is cached until the board changes; callers must treat it as read-only.
+        """
+        key = (category, time, ref_unix, state)
+        with self.store.lock, self._lock:
+            board = self.board(category, time, ref_unix, state)
+            cached = self.tables.get(key)
+            if cached is not None and cached[0] is board and cached[1] == board.version:
+                self.counters['table_hits'] += 1
+                self.tables.move_to_end(key)
+                return cached[2]
+            self.counters['table_misses'] += 1
+            table = board.table()
+            self.tables[key] = (board, board.version, table)
+            self.tables.move_to_end(key)
+            return table
+
+    def stats(self):
+        """Cache counters plus the number of boards and ranked tables held."""
+        with self._lock:
+            return dict(self.counters, boards=len(self.boards), tables=len(self.tables), max_boards=self.max_boards)
+
+    def materialize(self, ref_unix, times=('d', 'w', 'm'), categories=None, states=False):
+        """
+        Write the leaderboard table of every (category, time) at ref_unix to disk, and of every
+        (category, time, state) if states is True. Later board builds for these keys load the
+        table instead of ranking, for as long as the transaction data is unchanged.
+        :return: list of written table directories
+        """
+        written = []
+        with self.store.lock:
+            aggregates, _, df = self.store.aggregates()
+            source = self.store.fingerprint()
+            categories = list(aggregates.categories) if categories is None else categories
+            state_list = [None] + (sorted(df['state'].dropna().unique()) if states else [])
+            for category in categories:
+                for time in times:
+                    for state in state_list:
+                        path = self.table_path(category, time, ref_unix, state)
+                        os.makedirs(os.path.dirname(path), exist_ok=True)
+                        table = self.build(category, time, ref_unix, state).table()
+                        columnar.write_table(table, path, meta={"source": source})
+                        written.append(path)
+        return written
+
+    def on_rows(self, rows):
+        """
+        Store callback: apply newly appended rows to every affected board; None means the table was reloaded.
+        Rows are summed per user first, so a board takes one add per distinct user; a board whose
+        batch touches more than REBUILD_FRACTION of its users is dropped and rebuilt on next use.
+        """
+        with self._lock:
+            if rows is None:
+                self.counters['invalidations'] += len(self.boards)
+                self.boards.clear()
+                self.tables.clear()
+                self._seen.clear()
+                return
+            if not self.boards or rows.empty:
+                return
+            rows = rows.assign(cents=to_cents(rows['amt']))
+            times = rows['unix_time'].to_numpy()
+            dropped = []
+            for key, board in self.boards.items():
+                category, time, ref_unix, state = key
+                start, end = window_bounds(time, ref_unix)
+                mask = (rows['category'] == category).to_numpy()
+                if start is not None:
+                    mask = mask & (times >= start) & (times <= end)
+                if state is not None:
+                    mask = mask & (rows['state'] == state).to_numpy()
+                if not mask.any():
+                    continue
+                self.counters['rows_applied'] += int(np.count_nonzero(mask))
+                users = rows[mask].groupby('user_id', observed=True, sort=False).agg(
+                    cents=('cents', 'sum'), salary=('salary', 'first'), name=('name', 'first'))
+                if len(users) > REBUILD_FRACTION * max(len(board), 1):
+                    dropped.append(key)
+                    continue
+                for user_id, cents, salary, name in zip(users.index, users['cents'], users['salary'], users['name']):
+                    board.add(user_id, cents, salary, name)
+            for key in dropped:
+                del self.boards[key]
+                self.tables.pop(key, None)
+                # Requested before, so the next request builds a board again
+                self._seen[key] = None
+                self.counters['invalidations'] += 1
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_engine():
+    """Return the process-wide LeaderboardEngine over the process-wide store."""
+    global _engine
+    from transaction_store import get_store
+    with _engine_lock:
+        if _engine is None:
+            _engine = LeaderboardEngine(get_store())
+        return _engine
+
+
+if __name__ == "__main__":
+    import argparse
+    import datetime
+
+    parser = argparse.ArgumentParser(description="Materialize leaderboard tables for one reference time")
+    parser.add_argument("--ref_time", type=str, default="2019-02-15")
+    parser.add_argument("--times", type=str, default="dwm")
+    parser.add_argument("--states", action="store_true", help="also write one table per state")
+    args = parser.parse_args()
+
+    ref_unix = int(datetime.datetime.fromisoformat(args.ref_time).timestamp())
+    paths = get_engine().materialize(ref_unix, times=tuple(args.times), states=args.states)
+    print(f"wrote {len(paths)} leaderboard tables to {os.path.dirname(paths[0]) if paths else '-'}")
@@ -0,0 +1,139 @@
+"""
+Pre-generate advice for users and timeframes, so the analytics page finds it in the store
+instead of waiting on a completion in the request path.
+
+Payloads are built exactly like /api/analytics builds them (search_user totals, top 5
+categories), so the stored entries are the ones the route looks up. Payloads that are already
+in the store are skipped, which makes an interrupted run resumable by running it again.
+
+Usage:
+    python pregenerate_advice.py                                   # all users, d/w/m, short + detailed
+    python pregenerate_advice.py --users EuLe21 --times w m --workers 4
+    python pregenerate_advice.py --generator my_stub:generate      # offline, with a stub client
+"""
+import datetime
+import importlib
+import random
+import sys
+import time as time_module
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+import ai_advice
+from rank_generator import search_user
+from transaction_store import get_store
+
+DEFAULT_REF_TIME = datetime.datetime(2019, 2, 15)
+
+
+def build_advice_payload(user_id: str, time: str, ref_time: datetime.datetime, mode: str) -> Dict[str, Any]:
+    """The advice payload /api/analytics sends for (user_id, time, ref_time, mode)."""
+    raw = search_user(user_id, time, ref_time)
+    total = float(raw.get("total", 0))
+    budget = float(raw.get("budget", 0))
+    pie = [
+        {"category": category, "amount": float(amount), "proportion": float(amount) / total if total > 0 else 0}
+        for category, amount in raw.items()
+        if category not in ("total", "budget") and float(amount) > 0
+    ]
+    pie.sort(key=lambda r: r["amount"], reverse=True)
+    return {
+        "mode": mode,
+        "userId": user_id,
+        "time": time,
+        "total": total,
+        "budget": budget,
+        "budgetDelta": budget - total,
+        "topCategories": pie[:5],
+    }
+
+
+def with_retries(generate: Callable[[str, int], str], retries: int = 3, backoff: float = 1.0) -> Callable[[str, int], str]:
+    """Wrap generate so failures are retried with exponential backoff (plus jitter)."""
+
+    def call(prompt: str, max_tokens: int) -> str:
+        for attempt in range(retries + 1):
+            try:
+                return generate(prompt, max_tokens)
+            except Exception:
+                if attempt == retries:
+                    raise
+                time_module.sleep(backoff * (2 ** attempt) * (1 + random.random() / 2))
+        raise AssertionError("unreachable")
+
+    return call
+
+
+def pregenerate(
+    user_ids: Iterable[str],
+    times: Iterable[str] = ("d", "w", "m"),
+    modes: Iterable[str] = ("short", "detailed"),
+    ref_time: datetime.datetime = DEFAULT_REF_TIME,
+    generate: Optional[Callable[[str, int], str]] = None,
+    store_path: str = "",
+    workers: int = 4,
+    retries: int = 3,
+    backoff: float = 1.0,
+) -> Dict[str, int]:
+    """
+    Generate and store advice for every (user, time, mode) that is not in the store yet.
+
+    :param generate: generate(prompt, max_tokens) -> advice text, ai_advice.generate_advice if None
+    :param workers: maximum number of generations in flight
+    :param retries: retries per payload after a failed generation
+    :return: counts of generated, cached (already stored) and failed payloads
+    """
+    generate = with_retries(generate or ai_advice.generate_advice, retries, backoff)
+    payloads: List[Dict[str, Any]] = [
+        build_advice_payload(user_id, time, ref_time, mode)
+        for user_id in user_ids
+        for time in times
+        for mode in modes
+    ]
+    counts = {"generated": 0, "cached": 0, "failed": 0}
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        futures = {executor.submit(ai_advice.get_advice, p, store_path, generate): p for p in payloads}
+        for future in as_completed(futures):
+            p = futures[future]
+            try:
+                counts["cached" if future.result()["cached"] else "generated"] += 1
+            except Exception as e:
+                counts["failed"] += 1
+                print(f"failed {p['userId']} {p['time']} {p['mode']}: {type(e).__name__}: {e}", file=sys.stderr)
+    return counts
+
+
+def load_generator(spec: str) -> Callable[[str, int], str]:
+    """Import a generate(prompt, max_tokens) callable from "module:attribute"."""
+    module, _, attr = spec.partition(":")
+    return getattr(importlib.import_module(module), attr or "generate_advice")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=str, nargs="*", help="user ids, all users in the dataset if omitted")
+    parser.add_argument("--times", type=str, nargs="*", default=["d", "w", "m"])
+    parser.add_argument("--modes", type=str, nargs="*", default=["short", "detailed"])
+    parser.add_argument("--ref_time", type=str, default=DEFAULT_REF_TIME.isoformat())
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--retries", type=int, default=3)
+    parser.add_argument("--backoff", type=float, default=1.0)
+    parser.add_argument("--store_path", type=str, default="")
+    parser.add_argument("--generator", type=str, default=None, help="module:function to use instead of OpenAI")
+    args = parser.parse_args()
+
+    users = args.users or list(get_store().df['user_id'].unique())
+    counts = pregenerate(
+        users,
+        times=args.times,
+        modes=args.modes,
+        ref_time=datetime.datetime.fromisoformat(args.ref_time),
+        generate=load_generator(args.generator) if args.generator else None,
+        store_path=args.store_path,
+        workers=args.workers,
+        retries=args.retries,
+        backoff=args.backoff,
+    )
+    print(f"generated {counts['generated']}, already stored {counts['cached']}, failed {counts['failed']}")
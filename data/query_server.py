@@ -0,0 +1,215 @@
+"""
+Resident query server for the Next.js API routes.
+
+Keeps the transaction table warm in this process and answers queries over a
+newline-delimited JSON protocol, so the routes do not have to spawn a new Python
+interpreter (and re-read the dataset) for every HTTP request.
+
+Request (one JSON object per line):
+    {"id": 1, "method": "search_payload", "params": {"user_id": "EuLe21", "category": "home", "time": "w"}}
+Response (one JSON object per line, in completion order, matched by id):
+    {"id": 1, "ok": true, "result": {...}}
+    {"id": 1, "ok": false, "error": "..."}
+
+Usage:
+    python query_server.py                          # 127.0.0.1:8765
+    python query_server.py --port 9000
+    python query_server.py --socket /tmp/cuayo.sock
+"""
+import asyncio
+import datetime
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import history_generator
+import rank_generator
+from cohorts import get_cohort_engine
+from leaderboard import NEIGHBOR_RADIUS, TOP_K, get_engine
+from transaction_store import get_store
+
+DEFAULT_HOST = os.getenv("QUERY_SERVER_HOST", "127.0.0.1")
+DEFAULT_PORT = int(os.getenv("QUERY_SERVER_PORT", "8765"))
+DEFAULT_REF_TIME = datetime.datetime(2019, 2, 15)
+
+
+def parse_ref_time(value):
+    """Parse an ISO timestamp (a trailing Z is accepted) into a naive datetime."""
+    if not value:
+        return DEFAULT_REF_TIME
+    return datetime.datetime.fromisoformat(str(value).replace("Z", "+00:00")).replace(tzinfo=None)
+
+
+def to_jsonable(obj):
+    """Convert numpy scalars, datetimes and tuples in query results into plain JSON types."""
+    if isinstance(obj, dict):
+        return {str(k): to_jsonable(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [to_jsonable(v) for v in obj]
+    if isinstance(obj, (datetime.datetime, datetime.date)):
+        return obj.isoformat()
+    if isinstance(obj, np.integer):
+        return int(obj)
+    if isinstance(obj, np.floating):
+        return float(obj)
+    return obj
+
+
+def _search_df(user_id, category, time, ref_time=None, state=None, top_k=TOP_K, radius=NEIGHBOR_RADIUS):
+    return rank_generator.search_df(user_id, category, time, parse_ref_time(ref_time), state=state,
+                                    top_k=int(top_k), radius=int(radius))
+
+
+def _search_payload(user_id, category, time, ref_time=None, state=None, top_k=TOP_K, radius=NEIGHBOR_RADIUS):
+    return rank_generator.search_payload(user_id, category, time, parse_ref_time(ref_time), state=state,
+                                         top_k=int(top_k), radius=int(radius))
+
+
+def _rank_table(category, time, ref_time=None, state=None):
+    table = rank_generator.rank_table(category, time, parse_ref_time(ref_time), state=state)
+    return table.astype(object).where(table.notna(), None).to_dict(orient="list")
+
+
+def _cohort_payload(user_id, category, time, group, ref_time=None, cohort=None, top_k=TOP_K, radius=NEIGHBOR_RADIUS):
+    return rank_generator.cohort_payload(user_id, category, time, parse_ref_time(ref_time), group, cohort=cohort,
+                                         top_k=int(top_k), radius=int(radius))
+
+
+def _cohort_table(category, time, group, ref_time=None):
+    table = rank_generator.cohort_table(category, time, parse_ref_time(ref_time), group)
+    return table.astype(object).where(table.notna(), None).to_dict(orient="list")
+
+
+def _search_user(user_id, timeframe, ref_time=None):
+    return rank_generator.search_user(user_id, timeframe, parse_ref_time(ref_time))
+
+
+def _user_best_worst(user_id, time, ref_time=None):
+    return rank_generator.user_best_worst(user_id, time, parse_ref_time(ref_time))
+
+
+def _generate_history(user_id, category, timeframe, ref_time=None, n=10):
+    return history_generator.generate_history(user_id, category, timeframe, parse_ref_time(ref_time), n=int(n))
+
+
+def _update_df_many(transactions):
+    return {"appended": rank_generator.update_df_many(transactions)}
+
+
+def _advice(payload, store_path=""):
+    # Imported lazily so the rank queries work without the openai SDK installed
+    import ai_advice
+    return ai_advice.get_advice(payload, store_path)
+
+
+def _ping():
+    return {"rows": len(get_store().df)}
+
+
+def _leaderboard_stats():
+    return get_engine().stats()
+
+
+def _cohort_stats():
+    return get_cohort_engine().stats()
+
+
+METHODS = {
+    "search_df": _search_df,
+    "search_payload": _search_payload,
+    "rank_table": _rank_table,
+    "cohort_payload": _cohort_payload,
+    "cohort_table": _cohort_table,
+    "search_user": _search_user,
+    "user_best_worst": _user_best_worst,
+    "generate_history": _generate_history,
+    "update_df_many": _update_df_many,
+    "advice": _advice,
+    "leaderboard_stats": _leaderboard_stats,
+    "cohort_stats": _cohort_stats,
+    "ping": _ping,
+}
+
+
+class QueryServer:
+    """
+    asyncio NDJSON server. Each connection may pipeline any number of requests;
+    every request runs on a worker thread and its response is written as soon as it
+    is ready, so slow requests (e.g. advice generation) do not block fast ones.
+    """
+
+    def __init__(self, max_workers=8):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    async def handle_request(self, line, writer, write_lock):
+        request_id = None
+        try:
+            request = json.loads(line)
+            request_id = request.get("id")
+            method = METHODS.get(request.get("method"))
+            if method is None:
+                raise ValueError(f"unknown method: {request.get('method')!r}")
+            params = request.get("params") or {}
+            loop = asyncio.get_running_loop()
+            result = await loop.run_in_executor(self.executor, lambda: method(**params))
+            response = {"id": request_id, "ok": True, "result": to_jsonable(result)}
+        except Exception as e:
+            response = {"id": request_id, "ok": False, "error": f"{type(e).__name__}: {e}"}
+
+        data = (json.dumps(response, ensure_ascii=False) + "\n").encode("utf-8")
+        async with write_lock:
+            writer.write(data)
+            await writer.drain()
+
+    async def handle_connection(self, reader, writer):
+        write_lock = asyncio.Lock()
+        tasks = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                task = asyncio.create_task(self.handle_request(line, writer, write_lock))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+        finally:
+            writer.close()
+
+    async def serve(self, host=DEFAULT_HOST, port=DEFAULT_PORT, socket_path=None):
+        # Load the table before accepting connections so the first request is warm,
+        # and fold the transaction journal into the base table in the background
+        await asyncio.get_running_loop().run_in_executor(self.executor, lambda: get_store().df)
+        get_store().start_compactor()
+
+        if socket_path:
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+            server = await asyncio.start_unix_server(self.handle_connection, path=socket_path, limit=2**20)
+            print(f"query server listening on {socket_path}", flush=True)
+        else:
+            server = await asyncio.start_server(self.handle_connection, host, port, limit=2**20)
+            print(f"query server listening on {host}:{port}", flush=True)
+        async with server:
+            await server.serve_forever()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", type=str, default=DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--socket", type=str, default=os.getenv("QUERY_SERVER_SOCKET"))
+    parser.add_argument("--workers", type=int, default=8)
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(QueryServer(max_workers=args.workers).serve(args.host, args.port, args.socket))
+    except KeyboardInterrupt:
+        pass
@@ -3,8 +3,11 @@ import pandas as pd
 import datetime
 import os
 
+from cohorts import DIMENSIONS, age_band, get_cohort_engine
+from leaderboard import NEIGHBOR_RADIUS, TOP_K, get_engine, window_bounds
+from transaction_store import get_store
 
-def search_df(user_id, category, time, ref_time, state=None):
+def search_df(user_id, category, time, ref_time, state=None, top_k=TOP_K, radius=NEIGHBOR_RADIUS, ranks=False):
     """
     :param user_id: user_id of the user we want to find the rank and spent ratio for
     :param category: category of transactions to consider
@@ -14,118 +17,47 @@ def search_df(user_id, category, time, ref_time, state=None):
     :param time: time window to consider, either daily (d), weekly (w), or monthly (m)
     :param ref_time: reference time in datetime format
     :param state: state to create rank
+    :param top_k: number of top ranked users to return, default 3 (env LEADERBOARD_TOP_K)
+    :param radius: number of users right before and after me to return, default 1 (env LEADERBOARD_RADIUS)
+    :param ranks: if True, also return top_ranks, the rank of each user in top_users
     :return:
     user_spent_ratio: the spent ratio of the user_id in the given category, time window and state
     user_rank: the rank of the user_id in the given category, time window and state
     num_users: the number of user_ids with nonzero spent_ratio in the given category, time window and state
-    top_users: the list of user_ids of top 3 ranked users and the user of rank 
+    top_users: the list of user_ids of top_k ranked users and the radius users of rank 
                right before me and after me, and the list of spent_ratio of those users
-    top_spent_ratios: the list of spent_ratio of top 3 ranked users and the user of rank
+    top_spent_ratios: the list of spent_ratio of top_k ranked users and the radius users of rank
                      right before me and after me
+    top_ranks: only if ranks is True, the rank of each user in top_users
 
     Note that user_spent_ratio = 0 and user_rank = None 
             if the user hasn't spent money on category over time frame
     Note that top_users = top_spent_ratios = [] 
             if there are no transactions in category at all over time frame
     """
-    df = pd.read_csv(os.path.join(os.path.dirname(__file__), "credit_card_transaction.csv"))
-    # Check if user_id is in df
-    if user_id not in df['user_id'].values:
+    # Check if user_id is in the user directory (a hash lookup)
+    if user_id not in get_store().users():
         raise ValueError("user_id not found in dataset. Please check the user_id and try again.")
-    #print(df.head())
-    # Category: filter by category
-    df = df[df['category'] == category]
-    # State: if not none, filter by state
-    if state is not None:
-        df = df[df['state'] == state]
     # Time: time is either daily (d), weekly (w), or monthly (m)
     # ref time is ref time in datetime format
     # convert ref time to unix time
     ref_time_unix = int(ref_time.timestamp())
-    # filter by time
-    if time == 'd':
-        df = df[(df['unix_time'] >= ref_time_unix - 86400) & (df['unix_time'] <= ref_time_unix)]
-    elif time == 'w':
-        df = df[(df['unix_time'] >= ref_time_unix - 7*86400) & (df['unix_time'] <= ref_time_unix)]
-    elif time == 'm':
-        df = df[(df['unix_time'] >= ref_time_unix - 30*86400) & (df['unix_time'] <= ref_time_unix)]
-
-    # Aggregate by amt
-    amt_spent_user = df.groupby('user_id')['amt'].sum().reset_index()
-    #print(amt_spent_user.head())
-    # If there is no data for all users
-    if amt_spent_user.empty:
-        return 0, None, None, [], []
-    #print(df.head())
-
-    # Make a new column spent_ratio = amt / (salary/12) if m, salary/52 if w, salary/365 if d
-    salary_ratio = 12 if time == 'm' else 52 if time == 'w' else 365
-    amt_spent_user = amt_spent_user.merge(df[['user_id', 'salary', 'name']].drop_duplicates(), on='user_id', how='left')
-    # Round to 4 digits after decimal
-    amt_spent_user['spent_ratio'] = (amt_spent_user['amt'] / (amt_spent_user['salary'] / salary_ratio)).round(4)
-
-    # Rank by spent_ratio
-    amt_spent_user['rank'] = amt_spent_user['spent_ratio'].rank(ascending=True, method='min')
-    ranked_df = amt_spent_user.sort_values(by='rank')
-    #print(ranked_df[ranked_df['user_id'] == user_id])
-
-    # Return the spent_ratio of user_id, rank of user_id, number of user_ids with nonzero values and the list of names of top 3 ranked users and the user of rank right before me and after me, and the list of spent_ratio of those users
-    if user_id in ranked_df['user_id'].values:
-        user_row = ranked_df[ranked_df['user_id'] == user_id].iloc[0]
-        user_spent_ratio = user_row['spent_ratio']
-        user_rank = int(user_row['rank'])
-        user_name = user_row['name'] if 'name' in user_row.index else None
-        if user_rank <= 3:
-            # User is in top 3, return only first 3 rows but ensure user's name appears (replace if tied)
-            top_3_df = ranked_df[ranked_df['rank'] <= 3].head(3).copy()
-            top_3_df = top_3_df[top_3_df['user_id'] != user_id]
-            top_3_df = pd.concat([top_3_df, user_row.to_frame().T], ignore_index=True)
-            top_3_df = top_3_df.sort_values(by='rank').head(3)
-            top_users = top_3_df['name'].tolist()
-            top_spent_ratios = top_3_df['spent_ratio'].tolist()
-            return user_spent_ratio, user_rank, len(ranked_df[ranked_df['spent_ratio'] > 0]), top_users, top_spent_ratios
-        else:
-            # User rank is greater than 3, so return top 3 names and one name before and after user
-            top_3_df = ranked_df[ranked_df['rank'] <= 3].head(3).copy()
-            top_users = top_3_df['name'].tolist()
-            top_spent_ratios = top_3_df['spent_ratio'].tolist()
-
-            # Get one user with rank < user_rank (right before)
-            before_user_df = ranked_df[ranked_df['rank'] < user_rank].tail(1)
-            # Get one user with rank > user_rank (right after)
-            after_user_df = ranked_df[ranked_df['rank'] > user_rank].head(1)
-
-            final_users = top_users.copy()
-            final_spent_ratios = top_spent_ratios.copy()
-
-            # Add before user if exists and not already in top 3
-            if not before_user_df.empty:
-                before_name = before_user_df.iloc[0]['name']
-                before_spent = before_user_df.iloc[0]['spent_ratio']
-                if before_name not in final_users:
-                    final_users.append(before_name)
-                    final_spent_ratios.append(before_spent)
-
-            # Add user's name
-            if user_name not in final_users:
-                final_users.append(user_name)
-                final_spent_ratios.append(user_spent_ratio)
-
-            # Add after user if exists and not already in top 3
-            if not after_user_df.empty:
-                after_name = after_user_df.iloc[0]['name']
-                after_spent = after_user_df.iloc[0]['spent_ratio']
-                if after_name not in final_users:
-                    final_users.append(after_name)
-                    final_spent_ratios.append(after_spent)
-
-            return user_spent_ratio, user_rank, len(ranked_df[ranked_df['spent_ratio'] > 0]), final_users, final_spent_ratios
-    else:
-        # Return 0, None, top 3 user names
-        top_3_df = ranked_df[ranked_df['rank'] <= 3].head(3)
-        top_users = top_3_df['name'].tolist()
-        top_spent_ratios = top_3_df['spent_ratio'].tolist()
-        return 0, None, len(ranked_df[ranked_df['spent_ratio'] > 0]), top_users, top_spent_ratios
+    # Rank, top k and neighbors from the leaderboard for (category, time, ref_time, state):
+    # a partial selection over the window totals on first use, then a board updated in place
+    # as new transactions arrive
+    return get_engine().search(user_id, category, time, ref_time_unix, state, k=top_k, radius=radius, ranks=ranks)
+
+def rank_table(category, time, ref_time, state=None):
+    """
+    :param category: category of transactions to consider
+    :param time: time window to consider, either daily (d), weekly (w), or monthly (m)
+    :param ref_time: reference time in datetime format
+    :param state: state to create rank
+    :return: DataFrame with one row per user with transactions in the window, in rank order:
+    user_id, name, amt, salary, spent_ratio, rank (same as search_df's user_rank) and
+    percentile (rank / num_users * 100, the rankings page's "Top x%")
+    """
+    return get_engine().table(category, time, int(ref_time.timestamp()), state)
 
 def update_df(user_id, category, time, amt, state):
     """
@@ -137,17 +69,93 @@ def update_df(user_id, category, time, amt, state):
     :param amt: amount of the transaction
     :param state: state where the transaction was made
     """ 
-    df = pd.read_csv(os.path.join(os.path.dirname(__file__), "credit_card_transaction.csv"))
+    store = get_store()
+    users = store.users()
     # Get salary of user_id
-    if user_id in df['user_id'].values:
-        salary = df[df['user_id'] == user_id]['salary'].values[0]
+    if user_id in users:
+        salary = users.salary(user_id)
+        name = users.name(user_id)
     else:
         raise ValueError("user_id not found in dataset. Please check the user_id and try again.")
     # Create a new row with the transaction data and append to df
-    new_row = {'user_id': user_id, 'category': category, 'unix_time': int(time.timestamp()), 'amt': amt, 'state': state, 'salary': salary}
-    df = pd.concat([df, pd.DataFrame([new_row])], ignore_index=True)
-    # Write the updated df to csv
-    df.to_csv(os.path.join(os.path.dirname(__file__), "credit_card_transaction.csv"), index=False)
+    new_row = {'user_id': user_id, 'category': category, 'unix_time': int(time.timestamp()), 'amt': amt, 'state': state, 'salary': salary,
+               'name': name}
+    # O(1) append to the transaction journal; readers merge it with the base table
+    store.append(pd.DataFrame([new_row]))
+
+def _read_transactions(source, fmt=None):
+    """Read a batch of transactions from a list of dicts, DataFrame, path or open file (CSV or JSONL)."""
+    if isinstance(source, pd.DataFrame):
+        return source
+    if isinstance(source, (list, tuple)):
+        return pd.DataFrame(list(source))
+    if fmt is None:
+        name = source if isinstance(source, (str, os.PathLike)) else getattr(source, "name", "")
+        fmt = "jsonl" if str(name).endswith((".jsonl", ".ndjson")) else "csv"
+    if fmt == "jsonl":
+        return pd.read_json(source, lines=True, convert_dates=False, keep_default_dates=False)
+    return pd.read_csv(source)
+
+def _to_unix(times):
+    """
+    Convert a column of datetimes / ISO strings / unix seconds to float unix seconds (naive times
+    are local, like update_df). Missing or unparseable times are NaN.
+    """
+    if pd.api.types.is_numeric_dtype(times):
+        return times.astype('float64')
+    times = pd.to_datetime(times, format="ISO8601", errors='coerce')
+    if times.dt.tz is None:
+        from dateutil import tz
+        times = times.dt.tz_localize(tz.tzlocal(), ambiguous='NaT', nonexistent='shift_forward')
+    return (times - pd.Timestamp(0, tz='UTC')) // pd.Timedelta(seconds=1)
+
+def update_df_many(transactions, fmt=None):
+    """
+    Bulk version of update_df: validate and append a batch of transactions in one write.
+
+    :param transactions: list of dicts, DataFrame, or path / open file of CSV or JSONL records.
+        Each record needs user_id, category, amt, state and either time (datetime or ISO string)
+        or unix_time
+    :param fmt: "csv" or "jsonl" for file input; guessed from the file extension if None
+    :return: number of transactions appended
+    """
+    batch = _read_transactions(transactions, fmt)
+    if batch.empty:
+        return 0
+    missing = {'user_id', 'category', 'amt', 'state'} - set(batch.columns)
+    if 'time' not in batch.columns and 'unix_time' not in batch.columns:
+        missing.add('time')
+    if missing:
+        raise ValueError(f"transactions are missing columns: {sorted(missing)}")
+
+    store = get_store()
+    users = store.users()
+    # Validate all user_ids at once against the user directory
+    known = pd.Series(users.contains(batch['user_id']), index=batch.index)
+    if not known.all():
+        unknown = batch.loc[~known, 'user_id'].unique()[:10].tolist()
+        raise ValueError(f"user_id not found in dataset: {unknown}. Please check the user_ids and try again.")
+
+    # Per record: unix_time if it has one, else its converted time
+    unix_time = pd.Series(np.nan, index=batch.index)
+    if 'unix_time' in batch.columns:
+        unix_time = _to_unix(batch['unix_time'])
+    if 'time' in batch.columns:
+        unix_time = unix_time.fillna(_to_unix(batch['time']))
+    if unix_time.isna().any():
+        raise ValueError("transactions contain times that cannot be converted to unix time.")
+    rows = pd.DataFrame({
+        'user_id': batch['user_id'].astype(str),
+        'category': batch['category'].astype(str),
+        'unix_time': unix_time.astype('int64'),
+        'amt': batch['amt'].astype(float),
+        'state': batch['state'].astype(str),
+    })
+    # Salary and name of every row in one gather from the user directory
+    info = users.gather(rows['user_id'], ['salary', 'name'])
+    rows = rows.assign(salary=info['salary'].to_numpy(dtype=np.float64), name=info['name'].to_numpy())
+    store.append(rows)
+    return len(rows)
 
 def user_best_worst(user_id, time, ref_time):
     """
@@ -163,60 +171,44 @@ def user_best_worst(user_id, time, ref_time):
     If there are no transactions for the user_id in the given time window, return None, None
     Return in json format: {"best_category": best_category, "worst_category": worst_category, "best_rank": best_rank, "worst_rank": worst_rank}
     """
-    # Read transactions once and perform vectorized per-category ranking.
-    df = pd.read_csv(os.path.join(os.path.dirname(__file__), "credit_card_transaction.csv"))
+    # Use the shared in-memory table and the daily prefix sums for per-category ranking.
+    aggregates, index, df = get_store().aggregates()
     # Check if user_id exists globally in dataset
-    if user_id not in df['user_id'].values:
+    if user_id not in get_store().users():
         raise ValueError("user_id not found in dataset. Please check the user_id and try again.")
 
     categories = {'food_dining', 'travel', 'entertainment', 'personal_care', 'grocery',
                   'health_fitness', 'kids_pets', 'misc', 'gas_transport', 'home', 'shopping'}
 
-    # Compute time window bounds
+    # Compute time window bounds (anything other than d / w is a monthly window)
     ref_unix = int(ref_time.timestamp())
-    if time == 'd':
-        min_unix = ref_unix - 86400
-    elif time == 'w':
-        min_unix = ref_unix - 7 * 86400
-    else:  # 'm'
-        min_unix = ref_unix - 30 * 86400
-
-    # Filter rows by time window and categories of interest (one pass)
-    df_time = df[(df['unix_time'] >= min_unix) & (df['unix_time'] <= ref_unix) & (df['category'].isin(categories))]
-    if df_time.empty:
-        return {"best_category": None, "worst_category": None, "best_rank": None, "worst_rank": None}
+    min_unix, _ = window_bounds(time if time in ('d', 'w') else 'm', ref_unix)
 
-    # Precompute user info (salary, name) once
-    user_info = df[['user_id', 'salary', 'name']].drop_duplicates(subset=['user_id'])
-
-    # Sum amounts per category and user (vectorized)
-    cat_user_amt = df_time.groupby(['category', 'user_id'], sort=False)['amt'].sum().reset_index()
-    cat_user_amt = cat_user_amt.merge(user_info, on='user_id', how='left')
+    # Categories the user spent on in the window, in order of their first transaction in the table
+    user_window = index.window(df, min_unix, ref_unix, user_id=user_id)
+    user_categories = [c for c in pd.unique(user_window['category'].astype(object)) if c in categories]
+    if not user_categories:
+        return {"best_category": None, "worst_category": None, "best_rank": None, "worst_rank": None}
 
     # Compute spent_ratio using same salary ratio logic as search_df
     salary_ratio = 12 if time == 'm' else 52 if time == 'w' else 365
-    cat_user_amt['spent_ratio'] = (cat_user_amt['amt'] / (cat_user_amt['salary'] / salary_ratio)).round(4)
+    user_code = aggregates.user_code(user_id)
 
-    # Rank within each category (preserve original ranking direction)
-    # NOTE: original used ascending=True, method='min' so we keep that to avoid changing semantics
-    cat_user_amt['rank'] = cat_user_amt.groupby('category')['spent_ratio'].rank(ascending=True, method='min')
-
-    # Extract the user's per-category ranks
-    user_rows = cat_user_amt[cat_user_amt['user_id'] == user_id]
-    if user_rows.empty:
-        return {"best_category": None, "worst_category": None, "best_rank": None, "worst_rank": None}
+    # Rank within each category (ascending, method='min' semantics): 1 + number of users with a lower spent_ratio
+    user_ranks = []
+    for category in user_categories:
+        cents, counts = aggregates.category_totals(df, index, category, min_unix, ref_unix)
+        active = counts > 0
+        spent_ratio = np.round(cents / 100 / (aggregates.salary / salary_ratio), 4)
+        user_ranks.append(int((spent_ratio[active] < spent_ratio[user_code]).sum()) + 1)
 
     # Determine best (minimum rank) and worst (maximum rank) categories for the user
-    user_rows = user_rows[['category', 'rank']]
-    # Convert rank to integer where possible
-    user_rows['rank'] = user_rows['rank'].astype(int)
-
-    best_idx = user_rows['rank'].idxmin()
-    worst_idx = user_rows['rank'].idxmax()
-    best_category = user_rows.loc[best_idx, 'category']
-    worst_category = user_rows.loc[worst_idx, 'category']
-    best_rank = int(user_rows.loc[best_idx, 'rank'])
-    worst_rank = int(user_rows.loc[worst_idx, 'rank'])
+    best_idx = int(np.argmin(user_ranks))
+    worst_idx = int(np.argmax(user_ranks))
+    best_category = user_categories[best_idx]
+    worst_category = user_categories[worst_idx]
+    best_rank = user_ranks[best_idx]
+    worst_rank = user_ranks[worst_idx]
 
     return {"best_category": best_category, "worst_category": worst_category, "best_rank": best_rank, "worst_rank": worst_rank}
 
@@ -229,26 +221,18 @@ def search_user(user_id, timeframe, ref_time):
     :return: a json style output of the user's transactions in the given time window, with the 
     total amount spent in each category and the total amount spent overall
     """
-    df = pd.read_csv(os.path.join(os.path.dirname(__file__), "credit_card_transaction.csv"))
-    # Check if user_id is in df
-    if user_id not in df['user_id'].values:
+    aggregates, index, df = get_store().aggregates()
+    # Check if user_id is in the user directory
+    if user_id not in get_store().users():
         raise ValueError("user_id not found in dataset. Please check the user_id and try again.")
-    # Filter by user_id and timeframe
-    df = df[df['user_id'] == user_id]
     # Get salary of user_id
-    salary = df['salary'].values[0]
-    df = df[df['unix_time'] <= ref_time.timestamp()]
-    if timeframe == 'd':
-        df = df[df['unix_time'] >= ref_time.timestamp() - 86400]
-    elif timeframe == 'w':
-        df = df[df['unix_time'] >= ref_time.timestamp() - 604800]
-    elif timeframe == 'm':
-        df = df[df['unix_time'] >= ref_time.timestamp() - 2592000]
-    #print(df)
-    # Group by category and sum the amounts
-    category_totals = df.groupby('category')['amt'].sum()
+    salary = aggregates.salary[aggregates.user_code(user_id)]
+    # Per-category totals of the user over the timeframe from the daily prefix sums
+    start, _ = window_bounds(timeframe, ref_time.timestamp())
+    cents, counts = aggregates.user_totals(df, index, user_id, start, ref_time.timestamp())
+    category_totals = pd.Series(cents[counts > 0] / 100, index=aggregates.categories[counts > 0].astype(str)).sort_index()
     # Get total amount spent
-    total_spent = df['amt'].sum()
+    total_spent = cents.sum() / 100
     budget = salary / 12 if timeframe == 'm' else salary / 52 if timeframe == 'w' else salary / 365
     #print(salary)
     #print(budget)
@@ -264,27 +248,29 @@ def search_user(user_id, timeframe, ref_time):
     output['budget'] = round(budget,2)
     return output
 
-if __name__ == "__main__":
-    import argparse
-    import json
-    import sys
-
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--user_id", type=str, required=True)
-    parser.add_argument("--category", type=str, required=True)
-    parser.add_argument("--time", type=str, required=True)  # d / w / m
-    parser.add_argument("--state", type=str, default=None)
-    args = parser.parse_args()
-
-    # fixed reference time
-    ref_dt = datetime.datetime(2019, 2, 15)
+def search_payload(user_id, category, time, ref_time, state=None, top_k=TOP_K, radius=NEIGHBOR_RADIUS):
+    """
+    JSON-ready leaderboard payload for the rankings API, built from search_df output.
 
-    user_spent_ratio, user_rank, num_users, top_users, top_spent_ratios = search_df(
-        args.user_id,
-        args.category,
-        args.time,
-        ref_dt,
-        state=args.state,
+    :param user_id: user_id of the user we want the leaderboard for
+    :param category: category of transactions to consider
+    :param time: time window to consider, either daily (d), weekly (w), or monthly (m)
+    :param ref_time: reference time in datetime format
+    :param state: state to create rank
+    :param top_k: number of top ranked users to show
+    :param radius: number of users to show right before and after the user
+    :return: dict with userSpentRatio, userRank, numUsers, topUsers, topSpentRatios,
+             displayEntries, topPercent and refTime
+    """
+    user_spent_ratio, user_rank, num_users, top_users, top_spent_ratios, top_ranks = search_df(
+        user_id,
+        category,
+        time,
+        ref_time,
+        state=state,
+        top_k=top_k,
+        radius=radius,
+        ranks=True,
     )
 
     top_percent = None
@@ -292,59 +278,105 @@ if __name__ == "__main__":
         top_percent = (user_rank / num_users) * 100
 
     # ------------------------------------------------------------
-    # Leaderboard display only: create displayEntries from search_df output
+    # Leaderboard display only: create displayEntries from search_df output,
+    # labelled with each listed user's rank ('min' ties, like userRank)
     # ------------------------------------------------------------
-    display_entries = []
-
-    # Defensive: align lengths
-    n = min(len(top_users), len(top_spent_ratios))
-    names = list(top_users)[:n]
-    ratios = [float(x) for x in list(top_spent_ratios)[:n]]
-
-    # If user_rank is None (no spend in that category/time), we can only show top list as 1..N
-    if user_rank is None:
-        for i in range(n):
-            display_entries.append(
-                {"name": names[i], "rank": i + 1, "spent_ratio": ratios[i]}
-            )
-    else:
-        # Two cases based on how search_df constructs top list:
-        # - user_rank <= 3: search_df returns ONLY 3 users (top3, including me if in top3)
-        # - user_rank > 3: search_df returns [top3] + (before) + (me) + (after) (up to 6 entries)
-        if user_rank <= 3:
-            # show these 3 as ranks 1..3 (matches display intent)
-            for i in range(n):
-                display_entries.append(
-                    {"name": names[i], "rank": i + 1, "spent_ratio": ratios[i]}
-                )
-        else:
-            # expect positions: 0..2 = top3, 3 = before, 4 = me, 5 = after (some may be missing)
-            if n >= 1:
-                display_entries.append({"name": names[0], "rank": 1, "spent_ratio": ratios[0]})
-            if n >= 2:
-                display_entries.append({"name": names[1], "rank": 2, "spent_ratio": ratios[1]})
-            if n >= 3:
-                display_entries.append({"name": names[2], "rank": 3, "spent_ratio": ratios[2]})
-            if n >= 4:
-                # this is a guess: "right before" is treated as rank-1
-                display_entries.append({"name": names[3], "rank": user_rank - 1, "spent_ratio": ratios[3]})
-            if n >= 5:
-                display_entries.append({"name": names[4], "rank": user_rank, "spent_ratio": ratios[4]})
-            if n >= 6:
-                # this is a guess: "right after" is treated as rank+1
-                display_entries.append({"name": names[5], "rank": user_rank + 1, "spent_ratio": ratios[5]})
+    display_entries = [
+        {"name": name, "rank": int(rank), "spent_ratio": float(ratio)}
+        for name, ratio, rank in zip(top_users, top_spent_ratios, top_ranks)
+    ]
 
     payload = {
         "userSpentRatio": float(user_spent_ratio),
         "userRank": user_rank,
-        "numUsers": int(num_users),
+        "numUsers": int(num_users or 0),
         "topUsers": list(top_users),
         "topSpentRatios": [float(x) for x in top_spent_ratios],
         # key change: provide displayEntries so route.ts can render ... correctly
         "displayEntries": display_entries,
         "topPercent": None if top_percent is None else float(top_percent),
-        "refTime": ref_dt.isoformat(),
+        "refTime": ref_time.isoformat(),
     }
+    return payload
+
+def cohort_payload(user_id, category, time, ref_time, group, cohort=None, top_k=TOP_K, radius=NEIGHBOR_RADIUS):
+    """
+    Rankings API payload for the user's rank among a cohort: the users who share the user's
+    home state, city, gender or age band (group). Same fields as search_payload, plus the
+    cohort label and the table of all cohorts of the group ranked against each other.
+
+    :param category: category of transactions to consider, or "all"
+    :param group: cohort dimension, one of state, city, gender, age (case insensitive)
+    :param cohort: cohort to rank in, the user's own cohort if None
+    :return: dict with userId, userName, cohort, userSpentRatio, userRank, numUsers, topUsers,
+             topSpentRatios, displayEntries, topPercent, cohorts and refTime
+    """
+    dimension = group.lower()
+    if dimension not in DIMENSIONS:
+        raise ValueError(f"group must be one of {DIMENSIONS}")
+    users = get_store().users()
+    if user_id not in users:
+        raise ValueError("user_id not found in dataset. Please check the user_id and try again.")
+    if cohort is None:
+        # The user's own cohort, also when the user has no spend in the window
+        cohort = users.get(user_id, dimension)
+        cohort = age_band([cohort])[0] if dimension == 'age' else cohort
+    cube = get_cohort_engine().cube(category, time, int(ref_time.timestamp()))
+    member = cube.member(user_id, dimension, cohort, k=top_k, radius=radius)
+    entries = [{"name": e["name"], "rank": e["rank"], "spent_ratio": float(e["spent_ratio"])} for e in member["entries"]]
+    return {
+        "userId": user_id,
+        "userName": users.name(user_id),
+        "cohort": member["cohort"],
+        "userSpentRatio": float(member["userSpentRatio"]),
+        "userRank": member["userRank"],
+        "numUsers": member["numUsers"],
+        "topUsers": [e["name"] for e in entries],
+        "topSpentRatios": [e["spent_ratio"] for e in entries],
+        "displayEntries": entries,
+        "topPercent": member["topPercent"],
+        "cohorts": cube.table(dimension).to_dict("records"),
+        "refTime": ref_time.isoformat(),
+    }
+
+def cohort_table(category, time, ref_time, group):
+    """
+    :param category: category of transactions to consider, or "all"
+    :param time: time window to consider, either daily (d), weekly (w), or monthly (m)
+    :param ref_time: reference time in datetime format
+    :param group: cohort dimension, one of state, city, gender, age (case insensitive)
+    :return: DataFrame with one row per cohort, in rank order: cohort, users, amt, avg_amt,
+    spent_ratio (mean over the cohort's users), median_spent_ratio, rank and percentile
+    """
+    dimension = group.lower()
+    if dimension not in DIMENSIONS:
+        raise ValueError(f"group must be one of {DIMENSIONS}")
+    return get_cohort_engine().cube(category, time, int(ref_time.timestamp())).table(dimension)
+
+if __name__ == "__main__":
+    import argparse
+    import json
+    import sys
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--user_id", type=str, required=True)
+    parser.add_argument("--category", type=str, required=True)
+    parser.add_argument("--time", type=str, required=True)  # d / w / m
+    parser.add_argument("--state", type=str, default=None)
+    parser.add_argument("--group", type=str, default=None, help="rank among the user's cohort: state, city, gender or age")
+    parser.add_argument("--top_k", type=int, default=TOP_K)
+    parser.add_argument("--radius", type=int, default=NEIGHBOR_RADIUS)
+    args = parser.parse_args()
+
+    # fixed reference time
+    ref_dt = datetime.datetime(2019, 2, 15)
+
+    if args.group:
+        payload = cohort_payload(args.user_id, args.category, args.time, ref_dt, args.group,
+                                 top_k=args.top_k, radius=args.radius)
+    else:
+        payload = search_payload(args.user_id, args.category, args.time, ref_dt, state=args.state,
+                                 top_k=args.top_k, radius=args.radius)
 
     print(json.dumps(payload))
     sys.stdout.flush()
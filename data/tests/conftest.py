@@ -0,0 +1,68 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+# The data modules import each other as top-level modules
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cohorts
+import leaderboard
+import transaction_store
+from transaction_store import TransactionStore
+
+CATEGORIES = ['grocery', 'travel', 'misc']
+STATES = ['PA', 'NY', 'OH']
+
+# Reference time of the test transactions: they fall in the 60 days before it
+REF_UNIX = 1562158800  # 2019-07-03 13:00 UTC
+
+
+def make_transactions(n_users=40, n_rows=2000, seed=0):
+    """Transaction table with the dataset's columns; every user's home attributes are fixed."""
+    rng = np.random.default_rng(seed)
+    users = pd.DataFrame({
+        'user_id': [f"U{i:04d}" for i in range(n_users)],
+        'name': [f"Name {i}" for i in range(n_users)],
+        'gender': rng.choice(['F', 'M'], n_users),
+        'city': rng.choice(['A', 'B', 'C'], n_users),
+        'age': rng.integers(18, 80, n_users),
+        'salary': rng.integers(20, 120, n_users) * 1000.0,
+    })
+    who = rng.integers(0, n_users, n_rows)
+    # Every user has at least one row
+    who[:n_users] = np.arange(n_users)
+    df = users.iloc[who].reset_index(drop=True)
+    df['state'] = rng.choice(STATES, n_rows)
+    df['category'] = rng.choice(CATEGORIES, n_rows)
+    df['amt'] = np.round(rng.gamma(2.0, 30.0, n_rows), 2)
+    df['unix_time'] = REF_UNIX - rng.integers(0, 60 * 86400, n_rows)
+    return df[['gender', 'city', 'state', 'category', 'amt', 'unix_time', 'age', 'user_id', 'name', 'salary']]
+
+
+@pytest.fixture
+def transactions():
+    return make_transactions()
+
+
+@pytest.fixture
+def csv_path(tmp_path, transactions):
+    path = str(tmp_path / "credit_card_transaction.csv")
+    transactions.to_csv(path, index=False)
+    return path
+
+
+@pytest.fixture
+def store(csv_path):
+    return TransactionStore(csv_path)
+
+
+@pytest.fixture
+def global_store(store, monkeypatch):
+    """Make store the process-wide store, with fresh leaderboard and cohort engines over it."""
+    monkeypatch.setattr(transaction_store, "_store", store)
+    monkeypatch.setattr(leaderboard, "_engine", None)
+    monkeypatch.setattr(cohorts, "_engine", None)
+    return store
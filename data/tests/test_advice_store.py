@@ -0,0 +1,101 @@
+import threading
+import time
+
+import ai_advice
+from advice_store import AdviceStore, PayloadBands
+
+PAYLOAD = {
+    "userId": "U0001",
+    "time": "m",
+    "mode": "short",
+    "total": 1000.0,
+    "budget": 4000.0,
+    "budgetDelta": -3000.0,
+    "topCategories": [
+        {"category": "grocery", "amount": 600.0, "proportion": 0.6},
+        {"category": "travel", "amount": 400.0, "proportion": 0.4},
+    ],
+}
+
+
+def with_fields(payload, **fields):
+    return dict(payload, **fields)
+
+
+def test_single_flight_generates_once(tmp_path):
+    store_path = str(tmp_path / "advice.db")
+    calls = []
+    start = threading.Barrier(8)
+    results = []
+
+    def generate(prompt, max_tokens):
+        calls.append(prompt)
+        time.sleep(0.2)
+        return "spend less on travel"
+
+    def ask():
+        start.wait()
+        results.append(ai_advice.get_advice(PAYLOAD, store_path, generate=generate))
+
+    threads = [threading.Thread(target=ask) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+    assert [r["advice"] for r in results] == ["spend less on travel"] * 8
+    assert sorted(r["cached"] for r in results) == [False] + [True] * 7
+
+
+def test_failed_generation_lets_the_next_caller_try(tmp_path):
+    store_path = str(tmp_path / "advice.db")
+
+    def fail(prompt, max_tokens):
+        raise RuntimeError("completion failed")
+
+    try:
+        ai_advice.get_advice(PAYLOAD, store_path, generate=fail)
+    except RuntimeError:
+        pass
+    result = ai_advice.get_advice(PAYLOAD, store_path, generate=lambda prompt, max_tokens: "advice")
+    assert result == {"ok": True, "advice": "advice", "cached": False}
+
+
+def test_payloads_in_the_same_bands_share_a_key():
+    bands = PayloadBands(money_band=0.05, ratio_band=0.05)
+    key = bands.key(PAYLOAD)
+    # 5% of the 4000 budget is 200: a few dollars more stays in the same money band
+    assert bands.key(with_fields(PAYLOAD, total=1003.5, budgetDelta=-2996.5)) == key
+    # topCategories order does not matter
+    assert bands.key(with_fields(PAYLOAD, topCategories=PAYLOAD["topCategories"][::-1])) == key
+    # Crossing a band, or changing a non-money field, changes the key
+    assert bands.key(with_fields(PAYLOAD, total=1400.0)) != key
+    assert bands.key(with_fields(PAYLOAD, topCategories=[
+        {"category": "grocery", "amount": 600.0, "proportion": 0.7},
+        {"category": "travel", "amount": 400.0, "proportion": 0.4},
+    ])) != key
+    assert bands.key(with_fields(PAYLOAD, userId="U0002")) != key
+
+
+def test_zero_bands_key_on_exact_values():
+    bands = PayloadBands(money_band=0, ratio_band=0)
+    assert bands.key(with_fields(PAYLOAD, total=1000.01)) != bands.key(PAYLOAD)
+    assert bands.key(with_fields(PAYLOAD, total=1000)) == bands.key(PAYLOAD)
+
+
+def test_band_hits_are_counted(tmp_path):
+    store = AdviceStore(str(tmp_path / "advice.db"), bands=PayloadBands(money_band=0.05, ratio_band=0.05))
+    assert store.get(PAYLOAD) == ""
+    store.put(PAYLOAD, "advice")
+    assert store.get(PAYLOAD) == "advice"
+    assert store.get(with_fields(PAYLOAD, total=1003.5)) == "advice"
+    stats = store.hit_stats()
+    assert (stats["exact_hits"], stats["band_hits"], stats["misses"]) == (1, 1, 1)
+
+
+def test_changing_bands_rekeys_stored_entries(tmp_path):
+    path = str(tmp_path / "advice.db")
+    AdviceStore(path, bands=PayloadBands(money_band=0, ratio_band=0)).put(PAYLOAD, "advice")
+    store = AdviceStore(path, bands=PayloadBands(money_band=0.05, ratio_band=0.05))
+    assert store.get(with_fields(PAYLOAD, total=1003.5)) == "advice"
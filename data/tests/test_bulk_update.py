@@ -0,0 +1,47 @@
+import datetime
+
+import pandas as pd
+import pytest
+
+import rank_generator
+
+
+def record(**fields):
+    return dict({"user_id": "U0001", "category": "misc", "amt": 2.5, "state": "PA"}, **fields)
+
+
+def test_update_df_many_mixes_time_and_unix_time(global_store):
+    # Naive times are local, like update_df
+    local = datetime.datetime(2019, 2, 12, 19, 33, 20)
+    batch = [
+        record(unix_time=1550000000),
+        record(time=local.isoformat()),
+        record(time=local + datetime.timedelta(seconds=1)),
+        record(unix_time=1550000003, time="2001-01-01T00:00:00"),
+    ]
+    assert rank_generator.update_df_many(batch) == 4
+
+    rows = global_store.df.tail(4)
+    expected = int(local.timestamp())
+    assert rows['unix_time'].tolist() == [1550000000, expected, expected + 1, 1550000003]
+    assert rows['salary'].tolist() == [global_store.users().salary("U0001")] * 4
+
+
+def test_update_df_many_reads_jsonl_unix_time_as_seconds(global_store, tmp_path):
+    path = tmp_path / "batch.jsonl"
+    pd.DataFrame([record(unix_time=1550000000), record(time="2019-02-12T19:33:20Z")]).to_json(
+        path, orient="records", lines=True)
+    assert rank_generator.update_df_many(str(path)) == 2
+    assert global_store.df['unix_time'].tail(2).tolist() == [1550000000, 1550000000]
+
+
+@pytest.mark.parametrize("batch", [
+    [record(unix_time=float("nan"))],
+    [record(unix_time=1550000000), record(time="not a time")],
+    [record(unix_time=1550000000), record()],
+])
+def test_update_df_many_rejects_missing_or_bad_times(global_store, batch):
+    size = len(global_store.df)
+    with pytest.raises(ValueError, match="cannot be converted to unix time"):
+        rank_generator.update_df_many(batch)
+    assert len(global_store.df) == size
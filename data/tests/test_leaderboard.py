@@ -0,0 +1,74 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from conftest import CATEGORIES, REF_UNIX, STATES
+from leaderboard import FenwickTree, Leaderboard, LeaderboardEngine
+from transaction_store import JOURNAL_COLUMNS
+
+KEYS = [(category, time, REF_UNIX, state) for category in CATEGORIES for time in 'dwm' for state in (None, 'PA')]
+
+
+def batch(transactions, n, seed, refunds=False):
+    """n journal rows for random users in the last 40 days before REF_UNIX."""
+    rng = np.random.default_rng(seed)
+    rows = transactions.sample(n, replace=True, random_state=seed)[JOURNAL_COLUMNS].reset_index(drop=True)
+    rows['category'] = rng.choice(CATEGORIES, n)
+    rows['state'] = rng.choice(STATES, n)
+    rows['unix_time'] = REF_UNIX - rng.integers(0, 40 * 86400, n)
+    rows['amt'] = np.round(rng.gamma(2.0, 30.0, n), 2)
+    if refunds:
+        # Refunds large enough to take window totals below zero
+        rows.loc[::3, 'amt'] = -5000.0
+    return rows
+
+
+def ranking(table):
+    return table.set_index('user_id')[['spent_ratio', 'rank']].sort_index()
+
+
+def assert_boards_match_fresh_build(store, engine):
+    fresh = LeaderboardEngine(store)
+    for key in KEYS:
+        pd.testing.assert_frame_equal(ranking(engine.table(*key)), ranking(fresh.build(*key).table()))
+
+
+@pytest.mark.parametrize("n, refunds", [(5, False), (40, True), (1500, False)])
+def test_board_updates_match_fresh_build(store, transactions, n, refunds):
+    engine = LeaderboardEngine(store)
+    for key in KEYS:
+        engine.board(*key)
+    store.append(batch(transactions, n, seed=n, refunds=refunds))
+    store.df
+    assert engine.counters['rows_applied'] > 0
+    assert_boards_match_fresh_build(store, engine)
+
+
+def test_large_batch_drops_boards(store, transactions):
+    engine = LeaderboardEngine(store)
+    for key in KEYS:
+        engine.board(*key)
+    store.append(batch(transactions, 1500, seed=1))
+    store.df
+    # Every board saw most of its users change, so it is rebuilt on next use instead
+    assert engine.counters['invalidations'] == len(KEYS)
+    assert not engine.boards
+    engine.search('U0001', *KEYS[0])
+    assert KEYS[0] in engine.boards
+
+
+def test_negative_totals_rank_first():
+    board = Leaderboard('d', ['a', 'b', 'c'], [500, 0, 100], [36500.0] * 3, ['A', 'B', 'C'])
+    board.add('b', -300)
+    board.add('d', -700, 36500.0, 'D')
+    assert [board.at(i) for i in range(4)] == ['d', 'b', 'c', 'a']
+    assert [board.rank(u) for u in 'dbca'] == [1, 2, 3, 4]
+    assert board.nonzero() == 2
+    board.add('d', 1000)
+    assert [board.at(i) for i in range(4)] == ['b', 'c', 'd', 'a']
+    assert board.rank('d') == 3
+
+
+def test_fenwick_tree_rejects_negative_buckets():
+    with pytest.raises(ValueError):
+        FenwickTree([1, 2, 3]).add(-1, 1)
@@ -0,0 +1,35 @@
+import datetime
+
+import pytest
+
+import leaderboard
+import rank_generator
+from conftest import REF_UNIX
+
+REF_TIME = datetime.datetime.fromtimestamp(REF_UNIX)
+
+
+def user_at_rank(table, rank):
+    return table.loc[table['rank'] == rank, 'user_id'].iloc[0]
+
+
+@pytest.mark.parametrize("board", [False, True])
+@pytest.mark.parametrize("radius", [1, 2, 3])
+@pytest.mark.parametrize("rank", [1, 4, 5, 6, 9])
+def test_display_entries_carry_true_ranks(global_store, board, radius, rank):
+    table = rank_generator.rank_table('grocery', 'm', REF_TIME)
+    if not board:
+        # The first request for a key is answered without a board (rank_slice)
+        leaderboard.get_engine().on_rows(None)
+    ranks = dict(zip(table['name'], table['rank']))
+    user_id = user_at_rank(table, rank)
+
+    payload = rank_generator.search_payload(user_id, 'grocery', 'm', REF_TIME, top_k=3, radius=radius)
+
+    assert payload['userRank'] == rank
+    entries = payload['displayEntries']
+    assert [e['rank'] for e in entries] == [ranks[e['name']] for e in entries]
+    assert {'name': global_store.users().name(user_id), 'rank': rank} in [
+        {'name': e['name'], 'rank': e['rank']} for e in entries]
+    assert [e['rank'] for e in entries] == sorted(e['rank'] for e in entries)
+    assert len(entries) == (3 if rank <= 3 else 3 + min(radius, rank - 4) + 1 + radius)
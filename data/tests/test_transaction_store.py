@@ -0,0 +1,99 @@
+import os
+import threading
+
+import pandas as pd
+
+import columnar
+from transaction_store import JOURNAL_COLUMNS, TransactionStore
+
+
+def journal_rows(transactions, n, amt=1.0):
+    rows = transactions.head(n)[JOURNAL_COLUMNS].copy()
+    rows['amt'] = amt
+    return rows
+
+
+def test_compaction_while_reader_refreshes(csv_path, transactions):
+    # Columnar-only table, as written by prepare_parallel: there is no CSV to fall back to
+    columnar.write_table(transactions, columnar.table_path(csv_path))
+    os.remove(csv_path)
+    writer = TransactionStore(csv_path)
+    readers = [TransactionStore(csv_path) for _ in range(3)]
+
+    stop = threading.Event()
+    errors, sizes = [], []
+
+    def refresh(reader):
+        while not stop.is_set():
+            try:
+                sizes.append(len(reader.df))
+            except Exception as e:
+                errors.append(e)
+                return
+
+    threads = [threading.Thread(target=refresh, args=(reader,)) for reader in readers]
+    for thread in threads:
+        thread.start()
+    try:
+        for _ in range(10):
+            writer.append(journal_rows(transactions, 25))
+            assert writer.compact() == 25
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+    assert errors == []
+    assert min(sizes) >= len(transactions)
+    assert all(len(reader.df) == len(transactions) + 250 for reader in readers)
+    assert not os.path.exists(writer.journal_path)
+    # Only the current version of the table is left on disk
+    assert len(os.listdir(columnar.table_path(csv_path))) == 2
+
+
+def test_compaction_swaps_the_table_in_atomically(csv_path, transactions, monkeypatch):
+    table_path = columnar.table_path(csv_path)
+    columnar.write_table(transactions, table_path)
+    os.remove(csv_path)
+    store = TransactionStore(csv_path)
+    store.append(journal_rows(transactions, 5))
+    rows = []
+    replace = os.replace
+
+    def readable():
+        assert columnar.exists(table_path)
+        rows.append(len(columnar.read_table(table_path, columns=['amt'])))
+
+    def checked_replace(src, dst):
+        # The table must be readable before and after every rename of the swap
+        readable()
+        replace(src, dst)
+        readable()
+
+    monkeypatch.setattr(os, "replace", checked_replace)
+    assert store.compact() == 5
+    monkeypatch.undo()
+    assert set(rows) == {len(transactions), len(transactions) + 5}
+
+
+def test_compact_keeps_home_attributes_and_dtypes(store, csv_path, transactions):
+    store.append(journal_rows(transactions, 30))
+    assert store.compact() == 30
+
+    df = pd.read_csv(csv_path)
+    assert len(df) == len(transactions) + 30
+    assert df.dtypes.equals(transactions.dtypes)
+    appended = df.tail(30).reset_index(drop=True)
+    expected = transactions.head(30).reset_index(drop=True)
+    pd.testing.assert_frame_equal(appended[['gender', 'city', 'age']], expected[['gender', 'city', 'age']])
+
+
+def test_compact_rewrites_csv_and_columnar_copy(store, csv_path, transactions):
+    columnar.write_table(transactions, columnar.table_path(csv_path))
+    store.append(journal_rows(transactions, 10, amt=5.0))
+    assert store.compact() == 10
+
+    table = columnar.read_table(columnar.table_path(csv_path))
+    assert len(table) == len(pd.read_csv(csv_path)) == len(transactions) + 10
+    assert table['age'].dtype == transactions['age'].dtype
+    assert len(store.df) == len(transactions) + 10
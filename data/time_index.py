@@ -0,0 +1,103 @@
+import numpy as np
+import pandas as pd
+
+# Rebuild the index once the unindexed tail (journal rows appended after the build)
+# grows past this fraction of the table
+MAX_TAIL_FRACTION = 0.05
+
+
+class SortedGroups:
+    """
+    Row positions grouped by an integer key and sorted by unix_time within each group.
+    Looking up a time window inside a group is two binary searches.
+    """
+
+    def __init__(self, keys, times):
+        order = np.lexsort((times, keys))
+        self.order = order
+        self.times = times[order]
+        self.keys, self.starts = np.unique(keys[order], return_index=True)
+        self.starts = np.append(self.starts, len(order))
+
+    def positions(self, key, start, end):
+        """Positions of the rows of group key with start <= unix_time <= end, sorted by time."""
+        i = np.searchsorted(self.keys, key)
+        if i == len(self.keys) or self.keys[i] != key:
+            return self.order[:0]
+        lo, hi = self.starts[i], self.starts[i + 1]
+        t = self.times[lo:hi]
+        a = lo + np.searchsorted(t, start, side='left')
+        b = lo + np.searchsorted(t, end, side='right')
+        return self.order[a:b]
+
+
+class TimeIndex:
+    """
+    Per-category (and per-user, per-(user, category)) time index over a transaction DataFrame.
+
+    Window queries use np.searchsorted on the time-sorted groups, so they touch only the
+    rows in the window instead of scanning the whole table. Rows appended to the table
+    after the index was built (the journal tail) are matched with a scan of the tail only.
+    Returned positions are in table order, so aggregates add up in the same order as a
+    boolean-mask filter would.
+    """
+
+    def __init__(self, df):
+        self.size = len(df)
+        times = df['unix_time'].to_numpy(dtype=np.int64)
+        cat_codes, categories = pd.factorize(df['category'])
+        user_codes, users = pd.factorize(df['user_id'])
+        self.category_codes = {c: i for i, c in enumerate(categories)}
+        self.user_codes = {u: i for i, u in enumerate(users)}
+        n_categories = max(len(categories), 1)
+        self.n_categories = n_categories
+        self.by_category = SortedGroups(cat_codes, times)
+        self.by_user = SortedGroups(user_codes, times)
+        self.by_user_category = SortedGroups(user_codes.astype(np.int64) * n_categories + cat_codes, times)
+
+    def covers(self, df):
+        """True if this index can serve df: same rows at the front, and a small enough tail."""
+        if len(df) < self.size:
+            return False
+        return len(df) - self.size <= MAX_TAIL_FRACTION * max(self.size, 1)
+
+    @staticmethod
+    def _bounds(start, end):
+        return (np.iinfo(np.int64).min if start is None else start,
+                np.iinfo(np.int64).max if end is None else end)
+
+    def _tail_positions(self, df, start, end, category=None, user_id=None):
+        tail = df.iloc[self.size:]
+        if tail.empty:
+            return np.empty(0, dtype=np.int64)
+        mask = (tail['unix_time'] >= start).to_numpy() & (tail['unix_time'] <= end).to_numpy()
+        if category is not None:
+            mask = mask & (tail['category'] == category).to_numpy()
+        if user_id is not None:
+            mask = mask & (tail['user_id'] == user_id).to_numpy()
+        return self.size + np.flatnonzero(mask)
+
+    def positions(self, df, start=None, end=None, category=None, user_id=None):
+        """
+        Positions in df of the rows with start <= unix_time <= end (None = unbounded),
+        optionally restricted to one category and/or one user.
+        """
+        start, end = self._bounds(start, end)
+        if category is not None and user_id is not None:
+            c, u = self.category_codes.get(category), self.user_codes.get(user_id)
+            found = self.by_user_category.positions(u * self.n_categories + c, start, end) if c is not None and u is not None else None
+        elif category is not None:
+            c = self.category_codes.get(category)
+            found = self.by_category.positions(c, start, end) if c is not None else None
+        elif user_id is not None:
+            u = self.user_codes.get(user_id)
+            found = self.by_user.positions(u, start, end) if u is not None else None
+        else:
+            found = self.by_category.order[(self.by_category.times >= start) & (self.by_category.times <= end)]
+        if found is None:
+            found = np.empty(0, dtype=np.int64)
+        return np.sort(np.concatenate([found, self._tail_positions(df, start, end, category, user_id)]))
+
+    def window(self, df, start=None, end=None, category=None, user_id=None):
+        """Rows of df in the window (see positions), in table order."""
+        return df.iloc[self.positions(df, start, end, category, user_id)]
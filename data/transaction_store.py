@@ -0,0 +1,459 @@
+import csv
+import fcntl
+import io
+import os
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+import columnar
+from daily_aggregates import DailyAggregates
+from time_index import TimeIndex
+from user_directory import ATTRIBUTES, UserDirectory
+
+DATA_PATH = os.getenv("TRANSACTIONS_PATH") or os.path.join(os.path.dirname(__file__), "credit_card_transaction.csv")
+
+# Column order of journal lines (the journal has no header)
+JOURNAL_COLUMNS = ['user_id', 'category', 'unix_time', 'amt', 'state', 'salary', 'name']
+
+# Fold the journal into the base table once it holds this many rows
+COMPACT_MIN_ROWS = int(os.getenv("TRANSACTIONS_COMPACT_MIN_ROWS", "10000"))
+
+
+# String columns that are dictionary encoded in memory (see encode_frame)
+ENCODED_COLUMNS = ['user_id', 'category', 'state', 'name']
+
+
+def _narrow(values, dtype):
+    """values as dtype if that loses nothing, else None."""
+    narrow = values.astype(dtype)
+    if np.array_equal(narrow.astype(values.dtype), values, equal_nan=values.dtype.kind == "f"):
+        return narrow
+    return None
+
+
+def encode_frame(df):
+    """
+    Compact in-memory form of a transaction table.
+
+    String columns in ENCODED_COLUMNS become Categoricals: an integer code per row plus one copy
+    of each distinct value (display names included), so == filters, isin and groupbys compare
+    integer codes instead of strings. float64 / int64 columns become float32 / int32 when every
+    value survives the round trip (salary and unix_time do, amt with its cents does not).
+    """
+    data = {}
+    for col in df.columns:
+        s = df[col]
+        if col in ENCODED_COLUMNS and not isinstance(s.dtype, pd.CategoricalDtype):
+            s = s.astype("category")
+        elif s.dtype == np.float64 or s.dtype == np.int64:
+            narrow = _narrow(s.to_numpy(), np.float32 if s.dtype == np.float64 else np.int32)
+            if narrow is not None:
+                s = pd.Series(narrow, index=s.index, name=col)
+        data[col] = s
+    return pd.DataFrame(data)
+
+
+def memory_report(df):
+    """
+    Bytes held by each column of df: {column: {"dtype", "bytes"}}.
+    Categorical columns count their codes and their dictionary.
+    """
+    report = {}
+    for col in df.columns:
+        s = df[col]
+        report[col] = {
+            "dtype": str(s.dtype) if not isinstance(s.dtype, pd.CategoricalDtype) else f"category[{s.cat.codes.dtype}]",
+            "bytes": int(s.memory_usage(index=False, deep=True)),
+        }
+    return report
+
+
+def _nbytes(obj, seen=None):
+    """Approximate bytes held by the numpy arrays and pandas Indexes reachable from obj."""
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if isinstance(obj, pd.Index):
+        return int(obj.memory_usage(deep=True))
+    if isinstance(obj, dict):
+        return sum(_nbytes(v, seen) for v in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return sum(_nbytes(v, seen) for v in obj)
+    if hasattr(obj, "__dict__"):
+        return _nbytes(vars(obj), seen)
+    return 0
+
+
+def concat_rows(df, rows):
+    """Concatenate rows onto df, keeping df's categorical columns categorical and narrowed columns narrow."""
+    rows = rows.copy()
+    for col in df.columns:
+        if col not in rows.columns:
+            continue
+        if df[col].dtype in (np.float32, np.int32) and pd.api.types.is_numeric_dtype(rows[col]):
+            narrow = _narrow(rows[col].to_numpy(), df[col].dtype)
+            if narrow is not None:
+                rows[col] = narrow
+        if isinstance(df[col].dtype, pd.CategoricalDtype):
+            categories = df[col].cat.categories
+            new = pd.Index(rows[col].dropna().unique()).difference(categories)
+            if len(new):
+                df = df.assign(**{col: df[col].cat.add_categories(new)})
+            rows[col] = pd.Categorical(rows[col], categories=df[col].cat.categories)
+    return pd.concat([df, rows], ignore_index=True)
+
+
+class TransactionStore:
+    """
+    Process-wide in-memory copy of the transaction table.
+
+    The table is a base file plus an append-only journal:
+    - base: the CSV, or its columnar copy if one exists (see columnar.py); only `columns` are loaded
+    - journal: <csv>.journal, one CSV line per new transaction (JOURNAL_COLUMNS, no header)
+
+    New transactions are appended to the journal in O(1) and readers merge it with the base.
+    compact() folds the journal into the base atomically. Every access to `df` re-stats both
+    files: a changed base triggers a full reload, a grown journal only reads the new lines.
+    A lock file serializes appends and compaction across processes. Callers must treat the
+    returned DataFrame as read-only.
+    """
+
+    def __init__(self, path=DATA_PATH, columns=columnar.QUERY_COLUMNS, auto_reload=True):
+        """
+        :param path: path of the transaction CSV
+        :param columns: columns to keep in memory, all columns if None
+        :param auto_reload: if True, reload the table whenever the files change on disk
+        """
+        self.path = path
+        self.table_path = columnar.table_path(path)
+        self.journal_path = path + ".journal"
+        self.lock_path = path + ".lock"
+        self.columns = columns
+        self.auto_reload = auto_reload
+        self._df = None
+        self._signature = None
+        self._journal_id = None
+        self._journal_offset = 0
+        self._lock = threading.RLock()
+        self._compactor = None
+        self._index = None
+        self._aggregates = None
+        self._users = None
+        self._listeners = []
+
+    @property
+    def is_columnar(self):
+        return columnar.exists(self.table_path)
+
+    @property
+    def lock(self):
+        """The store's in-process lock; hold it to read several derived structures consistently."""
+        return self._lock
+
+    def subscribe(self, listener):
+        """
+        Register listener(rows) to be called with the rows merged in from the journal,
+        or with None after a full reload (derived state must then be rebuilt).
+        """
+        with self._lock:
+            self._listeners.append(listener)
+
+    def _notify(self, rows):
+        for listener in self._listeners:
+            listener(rows)
+
+    @contextmanager
+    def file_lock(self, exclusive=True):
+        """Inter-process lock shared by appenders (exclusive), compaction (exclusive) and loads (shared)."""
+        with open(self.lock_path, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _file_signature(self):
+        if self.is_columnar:
+            stat = os.stat(os.path.join(self.table_path, columnar.META_FILE))
+        else:
+            stat = os.stat(self.path)
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def _journal_stat(self):
+        try:
+            stat = os.stat(self.journal_path)
+        except FileNotFoundError:
+            return None, 0
+        return (stat.st_dev, stat.st_ino), stat.st_size
+
+    @property
+    def df(self):
+        with self._lock:
+            if self._df is None:
+                self.reload()
+            elif self.auto_reload:
+                self.refresh()
+            return self._df
+
+    def fingerprint(self):
+        """Identifies the contents of the loaded table: base file signature and journal position."""
+        with self._lock:
+            self.df
+            return [*self._signature, self._journal_offset]
+
+    def time_index(self):
+        """
+        Return (TimeIndex, df) for the current table. The index is rebuilt lazily after a
+        full reload or once the journal tail it has not indexed grows too large.
+        """
+        with self._lock:
+            df = self.df
+            if self._index is None or not self._index.covers(df):
+                self._index = TimeIndex(df)
+            return self._index, df
+
+    def aggregates(self):
+        """
+        Return (DailyAggregates, TimeIndex, df) for the current table, all built from the same df.
+        Journal rows are served from the tail until it grows too large, then the aggregates are rebuilt.
+        """
+        with self._lock:
+            index, df = self.time_index()
+            if self._aggregates is None or not self._aggregates.covers(df):
+                self._aggregates = DailyAggregates(df)
+            return self._aggregates, index, df
+
+    def users(self):
+        """
+        Return the UserDirectory of the current table: built from the base table on reload
+        and extended with the users of journal rows as they are read.
+        """
+        with self._lock:
+            self.df
+            return self._users
+
+    def _available_columns(self):
+        if self.is_columnar:
+            return list(columnar.read_meta(self.table_path)["columns"])
+        return list(pd.read_csv(self.path, nrows=0).columns)
+
+    def _read(self, columns, encode=True):
+        """Read the base table; encoded for memory (see encode_frame) unless encode is False."""
+        if self.is_columnar:
+            df = columnar.read_table(self.table_path, columns=columns)
+        else:
+            df = pd.read_csv(self.path, usecols=columns)
+        return encode_frame(df) if encode else df
+
+    def memory_report(self):
+        """
+        Memory held by the loaded table: per-column report (see memory_report), plus the user
+        directory, and the time index and daily aggregates if they have been built.
+        """
+        with self._lock:
+            df = self.df
+            columns = memory_report(df)
+            report = {
+                "rows": len(df),
+                "columns": columns,
+                "table_bytes": sum(c["bytes"] for c in columns.values()),
+                "index_bytes": _nbytes(self._index) if self._index is not None else 0,
+                "aggregates_bytes": _nbytes(self._aggregates) if self._aggregates is not None else 0,
+                "users_bytes": _nbytes(self._users),
+            }
+            report["bytes_per_row"] = report["table_bytes"] / max(len(df), 1)
+            return report
+
+    def _read_journal(self, start):
+        """Read complete journal lines from byte offset start; return (rows, new offset)."""
+        try:
+            with open(self.journal_path, "rb") as f:
+                f.seek(start)
+                data = f.read()
+        except FileNotFoundError:
+            return None, 0
+        end = data.rfind(b"\n") + 1
+        if end == 0:
+            return None, start
+        rows = pd.read_csv(io.BytesIO(data[:end]), header=None, names=JOURNAL_COLUMNS)
+        if self.columns is not None:
+            rows = rows[[c for c in self.columns if c in rows.columns]]
+        return rows, start + end
+
+    def reload(self):
+        """Re-read the base table and the whole journal from disk unconditionally."""
+        with self._lock, self.file_lock(exclusive=False):
+            signature = self._file_signature()
+            # The user directory's attributes are read along with the table, then dropped from it
+            extra = [] if self.columns is None else [
+                c for c in self._available_columns() if c in ATTRIBUTES and c not in self.columns]
+            df = self._read(None if self.columns is None else self.columns + extra)
+            users = UserDirectory(df)
+            if extra:
+                df = df[[c for c in df.columns if c not in extra]]
+            journal_id, _ = self._journal_stat()
+            rows, offset = self._read_journal(0)
+            if rows is not None:
+                df = concat_rows(df, rows)
+                users.add(rows)
+            self._df = df
+            self._users = users
+            self._index = None
+            self._aggregates = None
+            self._signature = signature
+            self._journal_id = journal_id
+            self._journal_offset = offset
+            self._notify(None)
+            return self._df
+
+    def refresh(self):
+        """
+        Pick up changes on disk: full reload if the base or journal was replaced, else read new journal lines.
+        Runs under the shared file lock, so a compaction never swaps the base in between the checks.
+        """
+        with self._lock, self.file_lock(exclusive=False):
+            journal_id, size = self._journal_stat()
+            if self._file_signature() != self._signature or size < self._journal_offset:
+                return self.reload()
+            if journal_id != self._journal_id:
+                # A journal appearing where there was none is read incrementally from the start;
+                # a journal replaced under an unchanged base needs a full reload
+                if self._journal_id is not None:
+                    return self.reload()
+                self._journal_id = journal_id
+                self._journal_offset = 0
+            if size > self._journal_offset:
+                rows, offset = self._read_journal(self._journal_offset)
+                if rows is not None:
+                    self._df = concat_rows(self._df, rows)
+                    self._users.add(rows)
+                    self._journal_offset = offset
+                    self._notify(rows)
+            return self._df
+
+    def append(self, rows):
+        """
+        Append the rows DataFrame to the journal in a single write.
+        Cost does not depend on the size of the table; the in-memory copy picks the
+        rows up on the next access to `df`.
+        """
+        rows = rows.reindex(columns=JOURNAL_COLUMNS)
+        buf = io.StringIO()
+        csv.writer(buf, lineterminator="\n").writerows(rows.itertuples(index=False, name=None))
+        data = buf.getvalue().encode("utf-8")
+        with self._lock, self.file_lock():
+            fd = os.open(self.journal_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, data)
+            finally:
+                os.close(fd)
+
+    def journal_rows(self):
+        try:
+            with open(self.journal_path, "rb") as f:
+                return sum(1 for _ in f)
+        except FileNotFoundError:
+            return 0
+
+    def compact(self):
+        """
+        Fold the journal into the base table: the CSV, if there is one, and the columnar copy.
+        Appends and refreshes are blocked while the new base is written; the base is swapped
+        in atomically before the journal is removed.
+        :return: number of journal rows folded in
+        """
+        with self._lock:
+            # Taken before the exclusive file lock: loading the directory may need a shared one
+            users = self.users()
+            with self.file_lock():
+                n = self._compact(users)
+        if n:
+            self.reload()
+        return n
+
+    def _compact(self, users):
+        """Write the base table plus the journal rows as the new base and remove the journal; return the row count."""
+        rows, _ = self._read_journal(0) if os.path.exists(self.journal_path) else (None, 0)
+        if rows is None or rows.empty:
+            return 0
+        full = self._read(None, encode=False)
+        rows = rows.reindex(columns=JOURNAL_COLUMNS)
+        # Journal rows carry no home attributes (gender, city, age): take them from the user directory
+        extra = [a for a in users.attributes if a in full.columns and a not in rows.columns]
+        if extra:
+            rows = rows.assign(**users.gather(rows['user_id'], extra).set_axis(rows.index))
+        dtypes = full.dtypes
+        full = concat_rows(full, rows)
+        for col, dtype in dtypes.items():
+            if full[col].dtype != dtype and not full[col].isna().any():
+                full[col] = full[col].astype(dtype)
+        # The CSV is rewritten along with the columnar copy, so it never falls behind the table
+        if os.path.exists(self.path):
+            tmp = self.path + ".tmp"
+            full.to_csv(tmp, index=False)
+            os.replace(tmp, self.path)
+        if self.is_columnar:
+            columnar.write_table(full, self.table_path)
+        os.remove(self.journal_path)
+        return len(rows)
+
+    def start_compactor(self, interval=60.0, min_rows=COMPACT_MIN_ROWS):
+        """Start a daemon thread that compacts every `interval` seconds once the journal has min_rows rows."""
+        if self._compactor is not None:
+            return self._compactor
+        stop = threading.Event()
+
+        def run():
+            while not stop.wait(interval):
+                try:
+                    if self.journal_rows() >= min_rows:
+                        self.compact()
+                except Exception:
+                    pass
+
+        self._compactor = threading.Thread(target=run, name="transaction-compactor", daemon=True)
+        self._compactor.stop = stop
+        self._compactor.start()
+        return self._compactor
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    """Return the process-wide TransactionStore, creating it on first use."""
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = TransactionStore()
+        return _store
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", choices=["compact", "stats", "memory"])
+    args = parser.parse_args()
+
+    store = get_store()
+    if args.command == "compact":
+        print(f"compacted {store.compact()} journal rows into {store.table_path if store.is_columnar else store.path}")
+    elif args.command == "memory":
+        store.aggregates()
+        report = store.memory_report()
+        for col, c in report["columns"].items():
+            print(f"{col:<12} {c['dtype']:<18} {c['bytes'] / 2**20:10.1f} MiB")
+        print(f"table: {report['table_bytes'] / 2**20:.1f} MiB for {report['rows']} rows "
+              f"({report['bytes_per_row']:.1f} bytes/row)")
+        print(f"time index: {report['index_bytes'] / 2**20:.1f} MiB, daily aggregates: {report['aggregates_bytes'] / 2**20:.1f} MiB, "
+              f"user directory: {report['users_bytes'] / 2**20:.1f} MiB")
+    else:
+        print(f"rows: {len(store.df)}, journal rows: {store.journal_rows()}, columnar: {store.is_columnar}")
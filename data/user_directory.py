@@ -0,0 +1,80 @@
+import numpy as np
+import pandas as pd
+
+# Per-user attributes kept by the directory, when the table has them
+ATTRIBUTES = ['salary', 'name', 'state', 'age', 'gender', 'city']
+
+
+class UserDirectory:
+    """
+    One entry per user, indexed by user_id: salary, name, state, age, gender and city, taken
+    from each user's first row in the table.
+
+    user_ids live in a hashed pd.Index, so `user_id in directory` and single lookups are O(1)
+    instead of a scan of the transaction table, and gather() looks up many users with one
+    vectorized get_indexer plus array takes instead of a drop_duplicates + merge.
+    """
+
+    def __init__(self, df):
+        """
+        :param df: transaction rows with user_id and any of ATTRIBUTES
+        """
+        first = ~df['user_id'].duplicated().to_numpy() & df['user_id'].notna().to_numpy()
+        users = df[first]
+        self.user_ids = pd.Index(users['user_id'].astype(object).to_numpy(), name='user_id')
+        self.attributes = [a for a in ATTRIBUTES if a in df.columns]
+        self.columns = {a: self._values(users[a]) for a in self.attributes}
+
+    @staticmethod
+    def _values(s):
+        return s.astype(object).to_numpy() if isinstance(s.dtype, pd.CategoricalDtype) else s.to_numpy()
+
+    def __len__(self):
+        return len(self.user_ids)
+
+    def __contains__(self, user_id):
+        return user_id in self.user_ids
+
+    def position(self, user_id):
+        """Position of user_id in the directory; KeyError if the user is unknown."""
+        return self.user_ids.get_loc(user_id)
+
+    def get(self, user_id, attribute):
+        return self.columns[attribute][self.position(user_id)]
+
+    def salary(self, user_id):
+        return float(self.get(user_id, 'salary'))
+
+    def name(self, user_id):
+        return self.get(user_id, 'name')
+
+    def contains(self, user_ids):
+        """Boolean array: which of user_ids are in the directory."""
+        return self.user_ids.get_indexer(pd.Index(np.asarray(user_ids, dtype=object))) >= 0
+
+    def gather(self, user_ids, attributes=None):
+        """
+        Attributes of many users at once, in the order of user_ids.
+
+        :param attributes: attribute names, all the directory has if None
+        :return: DataFrame with one column per attribute; unknown users get NaN / None
+        """
+        positions = self.user_ids.get_indexer(pd.Index(np.asarray(user_ids, dtype=object)))
+        known = (positions >= 0).all()
+        data = {}
+        for a in attributes or self.attributes:
+            values = self.columns[a]
+            data[a] = values[positions] if known else pd.Series(values).reindex(positions).to_numpy()
+        return pd.DataFrame(data)
+
+    def add(self, rows):
+        """Add the users of rows that are not in the directory yet (first row of each); return how many."""
+        rows = rows[~self.contains(rows['user_id'])]
+        if rows.empty:
+            return 0
+        new = UserDirectory(rows)
+        self.user_ids = self.user_ids.append(new.user_ids)
+        for a in self.attributes:
+            extra = new.columns[a] if a in new.columns else np.full(len(new), np.nan, dtype=object)
+            self.columns[a] = np.concatenate([self.columns[a], extra])
+        return len(new)
@@ -1,10 +1,19 @@
 # pages/rankings.py
+import datetime
+import os
+import sys
+
 import streamlit as st
 import pandas as pd
 import numpy as np
 import altair as alt
 from math import erf, sqrt
 
+# Rankings come from the cohort engine in data/
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "..", "data"))
+from cohorts import COHORT_COLUMNS  # noqa: E402
+from rank_generator import cohort_payload  # noqa: E402
+
 st.set_page_config(page_title="Rankings", layout="wide")
 
 # -----------------------
@@ -13,10 +22,19 @@ st.set_page_config(page_title="Rankings", layout="wide")
 st.session_state.setdefault("rank_time", "Weekly")
 st.session_state.setdefault("rank_category", "Food")
 st.session_state.setdefault("rank_group", "City")
-
-# Fixed user marker (no UI)
-USER_LABEL = "You"
-USER_TOP_PERCENTILE = 1  # "Top 1%"
+st.session_state.setdefault("rank_user", "EuLe21")
+
+# Same fixed reference time as the rankings API
+REF_TIME = datetime.datetime(2019, 2, 15)
+TIME_CODES = {"Daily": "d", "Weekly": "w", "Monthly": "m"}
+# Demo categories -> dataset categories ("all": spend over every category)
+CATEGORY_CODES = {
+    "Food": "food_dining",
+    "Transportation": "gas_transport",
+    "Savings": "all",
+    "Entertainment": "entertainment",
+    "Flex": "shopping",
+}
 
 # -----------------------
 # Math helpers (no scipy)
@@ -36,92 +54,30 @@ def percentile_to_z_top(pct_top: float) -> float:
     return (lo + hi) / 2
 
 # -----------------------
-# Demo rankings generator
+# Cohort rankings (real data)
 # -----------------------
-def make_demo_rankings(time_choice: str, category: str, group: str, n: int = 40):
-    seed = abs(hash((time_choice, category, group))) % (2**32)
-    rng = np.random.default_rng(seed)
-
-    if group == "District":
-        groups = [f"District {i:02d}" for i in range(1, n + 1)]
-    elif group == "City":
-        groups = [f"City {i:02d}" for i in range(1, n + 1)]
-    elif group == "State":
-        groups = [f"State {i:02d}" for i in range(1, n + 1)]
-    elif group == "Gender":
-        groups = ["Female", "Male", "Non-binary", "Prefer not to say"]
-        n = len(groups)
-    elif group == "Age":
-        groups = ["<18", "18–24", "25–34", "35–44", "45–54", "55–64", "65+"]
-        n = len(groups)
-    else:
-        groups = [f"{group} {i:02d}" for i in range(1, n + 1)]
-
-    base = rng.normal(loc=100, scale=18, size=n).clip(10, 220)
-    metric = (base + rng.normal(0, 8, size=n)).clip(0, None)
-
+def load_rankings(user_id: str, time_choice: str, category: str, group: str):
+    """
+    The user's standing in their own cohort, and every cohort of the group ranked against the others.
+    Cohorts rank by mean spent ratio (spend / budget for the period), lowest first.
+    """
+    payload = cohort_payload(user_id, CATEGORY_CODES[category], TIME_CODES[time_choice], REF_TIME, group)
+    cohorts = pd.DataFrame(payload["cohorts"], columns=COHORT_COLUMNS)
     if category == "Savings":
-        score = metric
-        metric_name = "Saved ($)"
-    else:
-        score = 220 - metric
-        metric_name = "Spent ($)"
-
-    # Trend only (no delta shown)
-    if time_choice == "Daily":
-        delta = rng.normal(0, 4, size=n)
-    elif time_choice == "Weekly":
-        delta = rng.normal(0, 8, size=n)
+        metric_name = "Saved (% of budget)"
+        metric = (1 - cohorts["spent_ratio"]) * 100
     else:
-        delta = rng.normal(0, 12, size=n)
+        metric_name = "Spent per user ($)"
+        metric = cohorts["avg_amt"]
 
     df = pd.DataFrame({
-        "Group": groups,
-        metric_name: np.round(metric, 2),
-        "Score": np.round(score, 2),
-        "Trend": np.where(delta >= 0, "▲", "▼"),
+        "Rank": cohorts["rank"],
+        "Group": cohorts["cohort"],
+        metric_name: np.round(metric.astype(float), 2),
+        "Users": cohorts["users"],
+        "_is_user": cohorts["cohort"] == payload["cohort"],
     })
-
-    meta = {"metric_name": metric_name}
-    return df, meta
-
-# -----------------------
-# Insert user + rank (uses Score internally)
-# -----------------------
-def add_user_and_rank(df: pd.DataFrame, meta: dict, user_label: str, user_percentile_top: float):
-    scores = df["Score"].to_numpy(dtype=float)
-    mu = float(scores.mean())
-    sigma = float(scores.std(ddof=0))
-    if sigma < 1e-9:
-        sigma = 1.0
-
-    z = percentile_to_z_top(user_percentile_top)
-    user_score = mu + z * sigma
-
-    metric_name = meta["metric_name"]
-    if metric_name == "Saved ($)":
-        user_metric = user_score
-    else:
-        user_metric = 220 - user_score
-
-    user_row = {
-        "Group": user_label,
-        metric_name: round(float(user_metric), 2),
-        "Score": round(float(user_score), 2),
-        "Trend": "•",
-        "_is_user": True,
-    }
-
-    df2 = df.copy()
-    df2["_is_user"] = False
-    df2 = pd.concat([df2, pd.DataFrame([user_row])], ignore_index=True)
-
-    df2 = df2.sort_values("Score", ascending=False).reset_index(drop=True)
-    df2.insert(0, "Rank", np.arange(1, len(df2) + 1))
-
-    user_idx = int(df2.index[df2["_is_user"]].tolist()[0])
-    user_rank = int(df2.loc[user_idx, "Rank"])
-    return df2, mu, sigma, float(user_row["Score"]), user_rank
+    return df, payload, {"metric_name": metric_name}
 
 # -----------------------
 # Bell curve chart (Altair) - NO AXES
@@ -210,56 +166,66 @@ with left:
 
     st.session_state.rank_group = st.selectbox(
         "Group",
-        ["District", "City", "State", "Gender", "Age"],
-        index=["District", "City", "State", "Gender", "Age"]
+        ["City", "State", "Gender", "Age"],
+        index=["City", "State", "Gender", "Age"]
         .index(st.session_state.rank_group),
     )
 
+    st.session_state.rank_user = st.text_input("User ID", value=st.session_state.rank_user)
+
     st.caption("옵션을 바꾸면 자동으로 갱신됩니다.")
 
 with right:
-    raw_df, meta = make_demo_rankings(
-        st.session_state.rank_time,
-        st.session_state.rank_category,
-        st.session_state.rank_group,
-    )
+    try:
+        df, payload, meta = load_rankings(
+            st.session_state.rank_user.strip(),
+            st.session_state.rank_time,
+            st.session_state.rank_category,
+            st.session_state.rank_group,
+        )
+    except ValueError as e:
+        st.error(str(e))
+        st.stop()
 
-    df, mu, sigma, user_score, user_rank = add_user_and_rank(
-        raw_df, meta,
-        user_label=USER_LABEL,
-        user_percentile_top=float(USER_TOP_PERCENTILE),
-    )
+    top_percent = payload["topPercent"]
+    user_rank = payload["userRank"]
+    cohort = payload["cohort"] or "—"
 
     # Right area: curve (left) + full leaderboard (right)
     col_curve, col_full = st.columns([2.2, 2.8], vertical_alignment="top")
 
     with col_curve:
         st.markdown("#### Distribution")
-        st.altair_chart(
-            bell_curve_chart(mu, sigma, user_score, float(USER_TOP_PERCENTILE)),
-            use_container_width=True,
-        )
+        if top_percent is not None:
+            # Standard normal curve with the user's percentile in their cohort marked
+            st.altair_chart(
+                bell_curve_chart(0.0, 1.0, percentile_to_z_top(top_percent), top_percent),
+                use_container_width=True,
+            )
+            standing = f"Top {top_percent:.1f}% <span class=\"chip\">#{user_rank} / {payload['numUsers']}</span>"
+        else:
+            st.info("No spending in this category and time window.")
+            standing = f"Unranked <span class=\"chip\">{payload['numUsers']} ranked</span>"
 
         # "game-like" rank summary under curve
         st.markdown(
             f"""
             <div class="rank-badge">
-              <div class="rank-title">Your standing</div>
-              <div class="rank-main">Top {USER_TOP_PERCENTILE}% <span class="chip">#{user_rank} / {len(df)}</span></div>
-              <div class="rank-sub">This is shown like a game rank badge. (Demo)</div>
+              <div class="rank-title">Your standing in {cohort}</div>
+              <div class="rank-main">{standing}</div>
+              <div class="rank-sub">Ranked by spent ratio among users in your {st.session_state.rank_group.lower()} group.</div>
             </div>
             """,
             unsafe_allow_html=True,
         )
 
     with col_full:
-        st.markdown("#### Leaderboard")
+        st.markdown(f"#### {st.session_state.rank_group} leaderboard")
         show = df.copy()
         show["Group"] = np.where(show["_is_user"], "👉 " + show["Group"].astype(str), show["Group"].astype(str))
 
-        # No Score, no Delta
         st.dataframe(
-            show[["Rank", "Group", meta["metric_name"], "Trend"]],
+            show[["Rank", "Group", meta["metric_name"], "Users"]],
             use_container_width=True,
             hide_index=True,
         )